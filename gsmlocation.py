@@ -7,6 +7,7 @@ import math
 import numpy as np
 from scipy.optimize import minimize
 import sqlite3
+import functools
 import logging
 from datetime import datetime, timedelta
 from collections import defaultdict, deque
@@ -14,11 +15,119 @@ from optparse import OptionParser
 from scapy.all import sniff, IP, UDP
 import threading
 import time
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Dict, List, Set, Optional, Tuple, Any
 import csv
 import os
 
+try:
+    from numba import njit, prange
+    NUMBA_DISPONIBLE = True
+except ImportError:
+    NUMBA_DISPONIBLE = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        """Sustituto sin efecto cuando numba no está instalado"""
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda funcion: funcion
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+RADIO_TIERRA_KM = 6371.0
+
+# Códigos compactos de método para las estadísticas en arrays
+METODOS_UBICACION = ("2_CELDAS", "CENTROIDE", "RSSI_TOA", "COMBINADO")
+CODIGOS_METODO = {metodo: codigo for codigo, metodo in enumerate(METODOS_UBICACION)}
+
+def _json_por_defecto(objeto):
+    """Serializa los tipos que el módulo json estándar no admite"""
+    if isinstance(objeto, datetime):
+        return objeto.isoformat()
+    if isinstance(objeto, np.generic):
+        return objeto.item()
+    if isinstance(objeto, np.ndarray):
+        return objeto.tolist()
+    raise TypeError(f"Tipo no serializable: {type(objeto).__name__}")
+
+def serializar_json(datos: Any) -> bytes:
+    """Serializa a JSON compacto en UTF-8, con orjson si está instalado"""
+    if orjson is not None:
+        return orjson.dumps(datos, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(datos, default=_json_por_defecto, ensure_ascii=False).encode('utf-8')
+
+@njit(cache=True, fastmath=True)
+def _haversine_nb(lat1, lon1, lat2, lon2):
+    """Distancia haversine en kilómetros entre dos puntos"""
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    
+    a = (math.sin(dlat/2) * math.sin(dlat/2) +
+         math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
+         math.sin(dlon/2) * math.sin(dlon/2))
+    
+    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
+    return RADIO_TIERRA_KM * c
+
+@njit(cache=True, fastmath=True)
+def _haversine_batch_nb(lat0, lon0, lats, lons):
+    """Distancias haversine en kilómetros desde (lat0, lon0) a cada celda"""
+    distancias = np.empty(lats.shape[0], dtype=np.float64)
+    for i in range(lats.shape[0]):
+        distancias[i] = _haversine_nb(lat0, lon0, lats[i], lons[i])
+    return distancias
+
+@njit(cache=True, fastmath=True)
+def _error_conjunto_nb(posicion, lats, lons, rssi, tiempos, rssi_referencia, factor_perdida,
+                       peso_rssi, peso_toa):
+    """Error ponderado RSSI + TOA en `posicion` y su gradiente analítico (lat, lon)"""
+    # Aproximación equirrectangular: la búsqueda está acotada a ±0.1° y a esas
+    # distancias el error frente a haversine es despreciable (<0.1%)
+    rad = math.pi / 180
+    dlat = (lats - posicion[0]) * rad
+    dlon = (lons - posicion[1]) * rad
+    lat_media = (lats + posicion[0]) * (rad / 2)
+    cos_media = np.cos(lat_media)
+    x = dlon * cos_media
+    distancias = RADIO_TIERRA_KM * np.maximum(np.sqrt(x * x + dlat * dlat), 1e-12)
+    
+    # Residuos de ambos modelos sobre las mismas distancias
+    metros = distancias * 1000
+    residuo_rssi = rssi_referencia - factor_perdida * np.log10(np.maximum(metros, 1.0)) - rssi
+    residuo_toa = distancias / 300000 - tiempos  # velocidad de la luz en km/μs
+    valor = peso_rssi * np.sum(np.abs(residuo_rssi)) + peso_toa * np.sum(np.abs(residuo_toa))
+    
+    # Derivada del error respecto a cada distancia
+    derivada_perdida = np.where(metros > 1.0, factor_perdida / (distancias * math.log(10)), 0.0)
+    derivada_error = (-peso_rssi * np.sign(residuo_rssi) * derivada_perdida +
+                      peso_toa * np.sign(residuo_toa) / 300000)
+    
+    # Regla de la cadena a través de la distancia equirrectangular
+    derivada_d = derivada_error * RADIO_TIERRA_KM * RADIO_TIERRA_KM / distancias
+    gradiente = np.empty(2)
+    gradiente[0] = np.sum(derivada_d * (x * (-dlon * np.sin(lat_media) * rad / 2) - dlat * rad))
+    gradiente[1] = np.sum(derivada_d * (-x * cos_media * rad))
+    return valor, gradiente
+
+@njit(parallel=True, cache=True)
+def _intensidades_nb(precisiones):
+    """Intensidad de mapa de calor (0-1) para cada precisión en km"""
+    intensidades = np.empty_like(precisiones)
+    for i in prange(precisiones.size):
+        intensidades[i] = max(0.0, 1.0 - precisiones[i] / 10.0)
+    return intensidades
+
+if NUMBA_DISPONIBLE:
+    # Compilar (o cargar de la caché) los kernels al importar, no en plena captura
+    _unos = np.ones(3)
+    _haversine_batch_nb(0.0, 0.0, _unos, _unos)
+    _error_conjunto_nb(np.zeros(2), _unos, _unos, _unos, _unos, -30.0, 30.0, 1.0, 1.0)
+    _intensidades_nb(_unos)
+
 @dataclass
 class CeldaGSM:
     mcc: str
@@ -31,7 +140,13 @@ class CeldaGSM:
     latitude: float
     longitude: float
     timestamp: datetime
-    tipo_celda: str  'BCCH', 'TCH', etc.
+    tipo_celda: str  # 'BCCH', 'TCH', etc.
+    ubicacion_conocida: Optional[bool] = None  # None = aún no resuelta en la base de datos
+    clave: str = field(init=False, repr=False)
+    
+    def __post_init__(self):
+        # Clave de la celda en la base de datos, calculada una sola vez
+        self.clave = sys.intern(f"{self.mcc}-{self.mnc}-{self.lac}-{self.cell_id}")
 
 @dataclass
 class UbicacionEstimada:
@@ -42,209 +157,269 @@ class UbicacionEstimada:
     celdas_utilizadas: List[CeldaGSM]
     timestamp: datetime
 
+@dataclass
+class MedicionesApiladas:
+    """Mediciones con ubicación conocida en formato estructura-de-arrays"""
+    celdas: List[CeldaGSM]
+    lats: np.ndarray
+    lons: np.ndarray
+    senales: np.ndarray
+    
+    def __len__(self) -> int:
+        return len(self.celdas)
+
 class TrianguladorGSM:
-    def __init__(self):
-        self.estaciones_base = self._cargar_base_datos_estaciones()
-        self.historial_mediciones = defaultdict(list)
-        
-    def _cargar_base_datos_estaciones(self) -> Dict[str, Dict]:
-        """Carga base de datos de estaciones base conocidas"""
+    # Modelo log-distance calibrado usado por la trilateración lineal RSSI
+    RSSI_REFERENCIA_1M = -30.0  # dBm a 1 m de la estación base
+    EXPONENTE_PERDIDA = 3.0  # Entorno urbano
+    UMBRAL_RESIDUO_RSSI_DB = 6.0  # Residuo medio máximo para aceptar la solución cerrada
+    
+    def __init__(self, archivo_bd: str = "gsm_cells.db"):
+        self.conn = sqlite3.connect(archivo_bd, check_same_thread=False)
+        self.lock_bd = threading.Lock()
+        self._inicializar_bd_estaciones()
+        # Caché de ubicaciones por clave de celda sobre la consulta SQLite
+        self._buscar_ubicacion = functools.lru_cache(maxsize=4096)(self._consultar_ubicacion)
+        # Solo las últimas 50 mediciones por celda
+        self.historial_mediciones = defaultdict(lambda: deque(maxlen=50))
+    
+    def _inicializar_bd_estaciones(self):
+        """Crea la tabla de estaciones base y la importa del JSON si está vacía"""
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS estaciones_base (
+                clave TEXT PRIMARY KEY,
+                lat REAL,
+                lon REAL
+            ) WITHOUT ROWID
+        ''')
+        if self.conn.execute("SELECT 1 FROM estaciones_base LIMIT 1").fetchone() is None:
+            self._cargar_base_datos_estaciones()
+    
+    def _cargar_base_datos_estaciones(self):
+        """Importa la base de datos JSON de estaciones base conocidas"""
         try:
             with open('gsm_cell_database.json', 'r') as f:
-                return json.load(f)
+                estaciones = json.load(f)
         except FileNotFoundError:
             logging.warning("Base de datos de celdas GSM no encontrada")
-            return {}
+            return
+    
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO estaciones_base (clave, lat, lon) VALUES (?, ?, ?)",
+                ((clave, ubicacion['lat'], ubicacion['lon']) for clave, ubicacion in estaciones.items())
+            )
+    
+    def _consultar_ubicacion(self, clave: str) -> Optional[Tuple[float, float]]:
+        """Consulta la ubicación (lat, lon) de una celda en SQLite"""
+        with self.lock_bd:
+            return self.conn.execute(
+                "SELECT lat, lon FROM estaciones_base WHERE clave = ?", (clave,)
+            ).fetchone()
     
     def agregar_medicion_celda(self, celda: CeldaGSM):
         """Agrega una medición de celda para triangulación"""
-        clave = f"{celda.mcc}-{celda.mnc}-{celda.lac}-{celda.cell_id}"
-        self.historial_mediciones[clave].append(celda)
-        
-        # Mantener solo las últimas 50 mediciones por celda
-        if len(self.historial_mediciones[clave]) > 50:
-            self.historial_mediciones[clave].pop(0)
+        self._resolver_ubicacion(celda, self._buscar_ubicacion(celda.clave))
+        self.historial_mediciones[celda.clave].append(celda)
     
-    def triangular_ubicacion(self, mediciones_actuales: List[CeldaGSM]) -> Optional[UbicacionEstimada]:
+    def _resolver_ubicacion(self, celda: CeldaGSM, ubicacion: Optional[Tuple[float, float]]):
+        """Copia la ubicación de la base de datos a la medición (una sola vez)"""
+        if ubicacion:
+            celda.latitude, celda.longitude = ubicacion
+            celda.ubicacion_conocida = True
+        else:
+            celda.ubicacion_conocida = False
+    
+    def _apilar_mediciones(self, mediciones: List[CeldaGSM]) -> MedicionesApiladas:
+        """Filtra las celdas con ubicación conocida y las apila en arrays contiguos"""
+        celdas = []
+        for celda in mediciones:
+            if celda.ubicacion_conocida is None:
+                self._resolver_ubicacion(celda, self._buscar_ubicacion(celda.clave))
+            if celda.ubicacion_conocida:
+                celdas.append(celda)
+        
+        datos = np.fromiter(
+            ((celda.latitude, celda.longitude, celda.signal_strength) for celda in celdas),
+            dtype=np.dtype((np.float64, 3)),
+            count=len(celdas)
+        )
+        return MedicionesApiladas(
+            celdas=celdas,
+            lats=np.ascontiguousarray(datos[:, 0]),
+            lons=np.ascontiguousarray(datos[:, 1]),
+            senales=np.ascontiguousarray(datos[:, 2])
+        )
+    
+    def triangular_ubicacion(self, mediciones_actuales: List[CeldaGSM],
+                             ahora: Optional[datetime] = None) -> Optional[UbicacionEstimada]:
         """Realiza triangulación usando múltiples métodos"""
-        if len(mediciones_actuales) < 3:
-            return self._estimar_ubicacion_2_celdas(mediciones_actuales)
+        # Un único instante para todos los resultados parciales y el combinado
+        if ahora is None:
+            ahora = datetime.now()
         
         # Filtrar celdas con ubicación conocida
-        celdas_con_ubicacion = []
-        for celda in mediciones_actuales:
-            ubicacion = self._obtener_ubicacion_celda(celda)
-            if ubicacion:
-                celdas_con_ubicacion.append((celda, ubicacion))
-        
-        if len(celdas_con_ubicacion) < 2:
-            return None
-        
-        # Aplicar múltiples métodos de triangulación
-        resultados = []
+        celdas = self._apilar_mediciones(mediciones_actuales)
         
-        # 1. Triangulación por fuerza de señal
-        resultado_rssi = self._triangulacion_rssi(celdas_con_ubicacion)
-        if resultado_rssi:
-            resultados.append(resultado_rssi)
+        if len(mediciones_actuales) < 3:
+            return self._estimar_ubicacion_2_celdas(celdas, ahora)
         
-        # 2. Triangulación por tiempo de llegada (TOA)
-        resultado_toa = self._triangulacion_toa(celdas_con_ubicacion)
-        if resultado_toa:
-            resultados.append(resultado_toa)
+        if len(celdas) < 2:
+            return None
         
-        # 3. Método de centroide
-        resultado_centroide = self._metodo_centroide(celdas_con_ubicacion)
-        if resultado_centroide:
-            resultados.append(resultado_centroide)
+        # 1. Método de centroide (también sirve de punto inicial)
+        resultado_centroide = self._metodo_centroide(celdas, ahora)
         
-        if not resultados:
-            return None
+        # 2. Triangulación RSSI + TOA fusionada en un único objetivo
+        resultado_conjunto = self._triangulacion_conjunta(celdas, resultado_centroide, ahora)
+        if resultado_conjunto is None:
+            return resultado_centroide
         
         # Combinar resultados usando promedio ponderado
-        return self._combinar_resultados(resultados)
+        return self._combinar_resultados([resultado_conjunto, resultado_centroide], ahora)
     
-    def _triangulacion_rssi(self, celdas: List[Tuple[CeldaGSM, Dict]]) -> Optional[UbicacionEstimada]:
-        """Triangulación basada en fuerza de señal (RSSI)"""
+    def _triangulacion_conjunta(self, celdas: MedicionesApiladas, centroide: UbicacionEstimada,
+                                ahora: datetime) -> Optional[UbicacionEstimada]:
+        """Triangulación por fuerza de señal (RSSI) y tiempo de llegada (TOA) en un solo ajuste"""
         try:
-            def funcion_error(posicion):
-                lat, lon = posicion
-                error_total = 0
-                for celda, ubicacion in celdas:
-                    distancia_calculada = self._calcular_distancia(
-                        lat, lon, ubicacion['lat'], ubicacion['lon']
-                    )
-                    # Modelo de propagación de señal
-                    rssi_esperado = self._modelo_propagacion_rssi(
-                        distancia_calculada, celda.signal_strength
-                    )
-                    error = abs(rssi_esperado - celda.signal_strength)
-                    error_total += error
-                return error_total
+            lats_bs, lons_bs, rssi = celdas.lats, celdas.lons, celdas.senales
+            # Simulamos diferencias de tiempo basadas en fuerza de señal
+            tiempos_bs = self._rssi_a_tiempo(rssi)
             
-            # Punto inicial (promedio de ubicaciones de celdas)
-            lat_inicial = np.mean([ubicacion['lat'] for _, ubicacion in celdas])
-            lon_inicial = np.mean([ubicacion['lon'] for _, ubicacion in celdas])
+            # Modelo log-distance calibrado: PL0 fijo a 1 m y 10*n precalculado
+            argumentos = (lats_bs, lons_bs, rssi, tiempos_bs,
+                          self.RSSI_REFERENCIA_1M, 10 * self.EXPONENTE_PERDIDA)
             
-            resultado = minimize(
-                funcion_error, 
-                [lat_inicial, lon_inicial],
-                method='L-BFGS-B',
-                bounds=[(lat_inicial-0.1, lat_inicial+0.1), 
-                       (lon_inicial-0.1, lon_inicial+0.1)]
-            )
-            
-            if resultado.success:
-                return UbicacionEstimada(
-                    latitude=resultado.x[0],
-                    longitude=resultado.x[1],
-                    precision=resultado.fun,
-                    metodo="RSSI",
-                    celdas_utilizadas=[celda for celda, _ in celdas],
-                    timestamp=datetime.now()
-                )
-        except Exception as e:
-            logging.error(f"Error en triangulación RSSI: {e}")
-        
-        return None
-    
-    def _triangulacion_toa(self, celdas: List[Tuple[CeldaGSM, Dict]]) -> Optional[UbicacionEstimada]:
-        """Triangulación basada en tiempo de llegada (Time of Arrival)"""
-        try:
-            # Simulamos diferencias de tiempo basadas en fuerza de señal
-            tiempos = []
-            for celda, ubicacion in celdas:
-                # Estimación simplificada del tiempo basada en RSSI
-                tiempo_estimado = self._rssi_a_tiempo(celda.signal_strength)
-                tiempos.append((ubicacion['lat'], ubicacion['lon'], tiempo_estimado))
+            # El término TOA se deriva del propio RSSI: una solución cerrada aceptada
+            # ya está en el óptimo conjunto y no hace falta minimizar
+            solucion = self._trilateracion_lineal_rssi(celdas)
+            if solucion is not None:
+                return self._resultado_conjunto(celdas, solucion[0], solucion[1], ahora)
             
-            def funcion_error(posicion):
-                lat, lon = posicion
-                error_total = 0
-                for lat_bs, lon_bs, tiempo in tiempos:
-                    distancia = self._calcular_distancia(lat, lon, lat_bs, lon_bs)
-                    tiempo_calculado = distancia / 300000  # velocidad de la luz en km/μs
-                    error = abs(tiempo_calculado - tiempo)
-                    error_total += error
-                return error_total
+            x0 = np.array([centroide.latitude, centroide.longitude])
             
-            lat_inicial = np.mean([lat for lat, _, _ in tiempos])
-            lon_inicial = np.mean([lon for _, lon, _ in tiempos])
+            # Normalizar cada término por su valor inicial (dB y μs no son comparables)
+            error_rssi_inicial = _error_conjunto_nb(x0, *argumentos, 1.0, 0.0)[0]
+            error_toa_inicial = _error_conjunto_nb(x0, *argumentos, 0.0, 1.0)[0]
+            argumentos += (1 / max(error_rssi_inicial, 1e-9), 1 / max(error_toa_inicial, 1e-9))
+            error_inicial = _error_conjunto_nb(x0, *argumentos)[0]
             
+            # Objetivo compilado que devuelve valor y gradiente en una sola llamada
             resultado = minimize(
-                funcion_error,
-                [lat_inicial, lon_inicial],
-                method='L-BFGS-B'
+                _error_conjunto_nb,
+                x0,
+                args=argumentos,
+                jac=True,
+                method='L-BFGS-B',
+                bounds=[(x0[0]-0.1, x0[0]+0.1), 
+                       (x0[1]-0.1, x0[1]+0.1)]
             )
             
-            if resultado.success:
-                return UbicacionEstimada(
-                    latitude=resultado.x[0],
-                    longitude=resultado.x[1],
-                    precision=resultado.fun,
-                    metodo="TOA",
-                    celdas_utilizadas=[celda for celda, _ in celdas],
-                    timestamp=datetime.now()
-                )
+            # Con gradiente exacto la búsqueda lineal puede acabar en ABNORMAL en los
+            # pliegues de la norma L1 aun estando en el óptimo: basta con que mejore
+            if resultado.success or resultado.fun < error_inicial:
+                lat, lon = resultado.x
+                return self._resultado_conjunto(celdas, lat, lon, ahora)
         except Exception as e:
-            logging.error(f"Error en triangulación TOA: {e}")
+            logging.error(f"Error en triangulación RSSI/TOA: {e}")
         
         return None
     
-    def _metodo_centroide(self, celdas: List[Tuple[CeldaGSM, Dict]]) -> UbicacionEstimada:
+    def _resultado_conjunto(self, celdas: MedicionesApiladas, lat: float, lon: float,
+                            ahora: datetime) -> UbicacionEstimada:
+        """Ubicación RSSI_TOA con la precisión en las mismas unidades que la del centroide"""
+        # El objetivo de minimize está normalizado (≈1 en el óptimo): la precisión se
+        # expresa como el desajuste de distancias en grados
+        desajuste_km = (self._calcular_distancias(lat, lon, celdas.lats, celdas.lons) -
+                        self._distancias_por_rssi(celdas.senales))
+        precision = math.sqrt(np.mean(desajuste_km * desajuste_km)) / (RADIO_TIERRA_KM * math.pi / 180)
+        return UbicacionEstimada(
+            latitude=float(lat),
+            longitude=float(lon),
+            precision=precision,
+            metodo="RSSI_TOA",
+            celdas_utilizadas=list(celdas.celdas),
+            timestamp=ahora
+        )
+    
+    def _trilateracion_lineal_rssi(self, celdas: MedicionesApiladas) -> Optional[Tuple[float, float, float]]:
+        """Trilateración RSSI linealizada resuelta con mínimos cuadrados ponderados"""
+        if len(celdas) < 3:
+            return None
+        
+        lats_bs, lons_bs, rssi = celdas.lats, celdas.lons, celdas.senales
+        lat0, lon0 = lats_bs.mean(), lons_bs.mean()
+        
+        # Proyección local plana en km alrededor del punto medio
+        km_por_grado_lat = RADIO_TIERRA_KM * math.pi / 180
+        km_por_grado_lon = km_por_grado_lat * math.cos(math.radians(lat0))
+        x = (lons_bs - lon0) * km_por_grado_lon
+        y = (lats_bs - lat0) * km_por_grado_lat
+        
+        distancias = self._distancias_por_rssi(rssi)
+        
+        # Restar la ecuación de la celda más cercana elimina el término cuadrático
+        ref = int(np.argmin(distancias))
+        otras = np.arange(len(celdas)) != ref
+        A = 2 * np.column_stack((x[otras] - x[ref], y[otras] - y[ref]))
+        b = (distancias[ref]**2 - distancias[otras]**2 +
+             x[otras]**2 + y[otras]**2 - x[ref]**2 - y[ref]**2)
+        
+        # Ponderar por proximidad (señal más fuerte = ecuación más fiable)
+        raiz_pesos = 1 / np.sqrt(distancias[otras])
+        solucion, _, rango, _ = np.linalg.lstsq(A * raiz_pesos[:, None], b * raiz_pesos, rcond=None)
+        if rango < 2:
+            return None
+        
+        lat = lat0 + solucion[1] / km_por_grado_lat
+        lon = lon0 + solucion[0] / km_por_grado_lon
+        if abs(lat - lat0) > 0.1 or abs(lon - lon0) > 0.1:
+            return None
+        
+        # Aceptar solo si el modelo explica las señales medidas
+        distancias_estimadas = self._calcular_distancias(lat, lon, lats_bs, lons_bs)
+        rssi_esperado = self._modelo_propagacion_rssi(distancias_estimadas)
+        residuo = float(np.sum(np.abs(rssi_esperado - rssi)))
+        if residuo / len(celdas) > self.UMBRAL_RESIDUO_RSSI_DB:
+            return None
+        
+        return float(lat), float(lon), residuo
+    
+    def _metodo_centroide(self, celdas: MedicionesApiladas, ahora: datetime) -> UbicacionEstimada:
         """Método del centroide ponderado por fuerza de señal"""
-        lats = []
-        lons = []
-        pesos = []
-        
-        for celda, ubicacion in celdas:
-            lats.append(ubicacion['lat'])
-            lons.append(ubicacion['lon'])
-            # Ponderar por fuerza de señal (mayor señal = mayor peso)
-            pesos.append(celda.signal_strength)
-        
-        # Normalizar pesos
-        pesos = np.array(pesos)
-        if np.sum(pesos) > 0:
-            pesos = pesos / np.sum(pesos)
+        # Ponderar por fuerza de señal (mayor señal = mayor peso) y normalizar
+        pesos = celdas.senales
+        suma_pesos = pesos.sum()
+        if suma_pesos > 0:
+            pesos = pesos / suma_pesos
         else:
-            pesos = np.ones(len(pesos)) / len(pesos)
+            pesos = np.full(len(celdas), 1.0 / len(celdas))
         
-        lat_centroide = np.average(lats, weights=pesos)
-        lon_centroide = np.average(lons, weights=pesos)
+        lat_centroide = pesos @ celdas.lats
+        lon_centroide = pesos @ celdas.lons
         
         # Calcular precisión (desviación estándar ponderada)
-        precision = np.sqrt(
-            np.average((lats - lat_centroide)**2, weights=pesos) +
-            np.average((lons - lon_centroide)**2, weights=pesos)
-        )
+        dlat = celdas.lats - lat_centroide
+        dlon = celdas.lons - lon_centroide
+        precision = np.sqrt(pesos @ (dlat * dlat + dlon * dlon))
         
         return UbicacionEstimada(
             latitude=lat_centroide,
             longitude=lon_centroide,
             precision=precision,
             metodo="CENTROIDE",
-            celdas_utilizadas=[celda for celda, _ in celdas],
-            timestamp=datetime.now()
+            celdas_utilizadas=list(celdas.celdas),
+            timestamp=ahora
         )
     
-    def _estimar_ubicacion_2_celdas(self, celdas: List[CeldaGSM]) -> Optional[UbicacionEstimada]:
+    def _estimar_ubicacion_2_celdas(self, celdas: MedicionesApiladas,
+                                    ahora: datetime) -> Optional[UbicacionEstimada]:
         """Estima ubicación cuando solo hay 2 celdas disponibles"""
         if len(celdas) < 2:
             return None
         
-        celdas_con_ubicacion = []
-        for celda in celdas:
-            ubicacion = self._obtener_ubicacion_celda(celda)
-            if ubicacion:
-                celdas_con_ubicacion.append((celda, ubicacion))
-        
-        if len(celdas_con_ubicacion) < 2:
-            return None
-        
         # Método simplificado para 2 celdas
-        celda1, ubic1 = celdas_con_ubicacion[0]
-        celda2, ubic2 = celdas_con_ubicacion[1]
+        celda1, celda2 = celdas.celdas[0], celdas.celdas[1]
         
         # Interpolar basado en fuerza de señal relativa
         rssi_total = celda1.signal_strength + celda2.signal_strength
@@ -254,12 +429,12 @@ class TrianguladorGSM:
         else:
             peso1 = peso2 = 0.5
         
-        lat_estimada = ubic1['lat'] * peso1 + ubic2['lat'] * peso2
-        lon_estimada = ubic1['lon'] * peso1 + ubic2['lon'] * peso2
+        lat_estimada = celda1.latitude * peso1 + celda2.latitude * peso2
+        lon_estimada = celda1.longitude * peso1 + celda2.longitude * peso2
         
         # Estimación de precisión basada en distancia entre celdas
         distancia_celdas = self._calcular_distancia(
-            ubic1['lat'], ubic1['lon'], ubic2['lat'], ubic2['lon']
+            celda1.latitude, celda1.longitude, celda2.latitude, celda2.longitude
         )
         precision = distancia_celdas * 0.5  # Estimación conservadora
         
@@ -268,56 +443,63 @@ class TrianguladorGSM:
             longitude=lon_estimada,
             precision=precision,
             metodo="2_CELDAS",
-            celdas_utilizadas=celdas,
-            timestamp=datetime.now()
+            celdas_utilizadas=list(celdas.celdas),
+            timestamp=ahora
         )
     
     def _calcular_distancia(self, lat1: float, lon1: float, lat2: float, lon2: float) -> float:
         """Calcula distancia en kilómetros usando fórmula haversine"""
-        R = 6371  # Radio de la Tierra en km
+        return _haversine_nb(lat1, lon1, lat2, lon2)
+    
+    def _calcular_distancias(self, lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        """Calcula distancias haversine en kilómetros desde un punto a varias celdas"""
+        if NUMBA_DISPONIBLE:
+            return _haversine_batch_nb(float(lat), float(lon), lats, lons)
         
-        dlat = math.radians(lat2 - lat1)
-        dlon = math.radians(lon2 - lon1)
+        dlat = np.radians(lats - lat)
+        dlon = np.radians(lons - lon)
         
-        a = (math.sin(dlat/2) * math.sin(dlat/2) +
-             math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) *
-             math.sin(dlon/2) * math.sin(dlon/2))
+        a = (np.sin(dlat/2)**2 +
+             np.cos(np.radians(lat)) * np.cos(np.radians(lats)) *
+             np.sin(dlon/2)**2)
         
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-        return R * c
+        c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+        return RADIO_TIERRA_KM * c
+    
+    def _modelo_propagacion_rssi(self, distancia):
+        """Modelo de propagación de señal para estimar RSSI esperado (escalar o array)"""
+        # Modelo log-distance path loss con PL0 calibrado a 1 m
+        return (self.RSSI_REFERENCIA_1M -
+                10 * self.EXPONENTE_PERDIDA * np.log10(np.maximum(distancia * 1000, 1)))  # Evitar log(0)
     
-    def _modelo_propagacion_rssi(self, distancia: float, rssi_referencia: int) -> float:
-        """Modelo de propagación de señal para estimar RSSI esperado"""
-        # Modelo log-distance path loss
-        # Parámetros típicos para entorno urbano
-        PL0 = rssi_referencia  # Pérdida de camino a 1m
-        n = 3.0  # Exponente de pérdida de camino
-        return PL0 - 10 * n * math.log10(max(distancia * 1000, 1))  # Evitar log(0)
+    def _distancias_por_rssi(self, rssi):
+        """Inversión del modelo log-distance: distancia estimada en km (escalar o array)"""
+        return 10 ** ((self.RSSI_REFERENCIA_1M - rssi) / (10 * self.EXPONENTE_PERDIDA)) / 1000
     
-    def _rssi_a_tiempo(self, rssi: int) -> float:
-        """Convierte RSSI a tiempo estimado de llegada"""
+    def _rssi_a_tiempo(self, rssi):
+        """Convierte RSSI a tiempo estimado de llegada (escalar o array)"""
         # Conversión simplificada para simulación
-        return max(-rssi / 100, 0.001)  # Tiempo en microsegundos
+        return np.maximum(-rssi / 100, 0.001)  # Tiempo en microsegundos
     
     def _obtener_ubicacion_celda(self, celda: CeldaGSM) -> Optional[Dict]:
         """Obtiene ubicación de una celda de la base de datos"""
-        clave = f"{celda.mcc}-{celda.mnc}-{celda.lac}-{celda.cell_id}"
-        return self.estaciones_base.get(clave)
+        ubicacion = self._buscar_ubicacion(celda.clave)
+        if ubicacion is None:
+            return None
+        return {'lat': ubicacion[0], 'lon': ubicacion[1]}
     
-    def _combinar_resultados(self, resultados: List[UbicacionEstimada]) -> UbicacionEstimada:
+    def _combinar_resultados(self, resultados: List[UbicacionEstimada], ahora: datetime) -> UbicacionEstimada:
         """Combina múltiples resultados de triangulación"""
-        lats = [r.latitude for r in resultados]
-        lons = [r.longitude for r in resultados]
-        precisiones = [r.precision for r in resultados]
+        # Filas: lat, lon, precisión de cada resultado
+        datos = np.array(
+            [(r.latitude, r.longitude, r.precision) for r in resultados], dtype=np.float64
+        )
         
         # Ponderar por precisión (menor precisión = mayor peso)
-        pesos = [1/(p + 0.001) for p in precisiones]
-        pesos = np.array(pesos) / np.sum(pesos)
+        pesos = 1 / (datos[:, 2] + 0.001)
+        pesos /= pesos.sum()
         
-        lat_combinada = np.average(lats, weights=pesos)
-        lon_combinada = np.average(lons, weights=pesos)
-        
-        precision_combinada = np.average(precisiones, weights=pesos)
+        lat_combinada, lon_combinada, precision_combinada = pesos @ datos
         
         # Combinar todas las celdas utilizadas
         todas_celdas = []
@@ -330,7 +512,7 @@ class TrianguladorGSM:
             precision=precision_combinada,
             metodo="COMBINADO",
             celdas_utilizadas=todas_celdas,
-            timestamp=datetime.now()
+            timestamp=ahora
         )
 
 class MapeadorGSM:
@@ -339,7 +521,8 @@ class MapeadorGSM:
     def __init__(self, triangulador: TrianguladorGSM):
         self.triangulador = triangulador
         self.mapa_celdas = {}
-        self.trayectorias = defaultdict(list)
+        # Solo las últimas 100 ubicaciones por IMSI
+        self.trayectorias = defaultdict(lambda: deque(maxlen=100))
     
     def generar_mapa_heatmap(self, ubicaciones: List[UbicacionEstimada]) -> Dict:
         """Genera datos para mapa de calor de ubicaciones"""
@@ -348,7 +531,16 @@ class MapeadorGSM:
             'features': []
         }
         
-        for ubicacion in ubicaciones:
+        # Intensidad basada en precisión, calculada de una vez para todo el lote
+        precisiones = np.fromiter(
+            (ubicacion.precision for ubicacion in ubicaciones), dtype=np.float64, count=len(ubicaciones)
+        )
+        if NUMBA_DISPONIBLE:
+            intensidades = _intensidades_nb(precisiones)
+        else:
+            intensidades = np.maximum(0.0, 1.0 - precisiones / 10.0)
+        
+        for ubicacion, intensidad in zip(ubicaciones, intensidades.tolist()):
             feature = {
                 'type': 'Feature',
                 'geometry': {
@@ -358,8 +550,8 @@ class MapeadorGSM:
                 'properties': {
                     'precision': ubicacion.precision,
                     'metodo': ubicacion.metodo,
-                    'timestamp': ubicacion.timestamp.isoformat(),
-                    'intensity': max(0, 1 - ubicacion.precision / 10)  # Intensidad basada en precisión
+                    'timestamp': ubicacion.timestamp,
+                    'intensity': intensidad
                 }
             }
             heatmap_data['features'].append(feature)
@@ -400,10 +592,6 @@ class MapeadorGSM:
     def actualizar_trayectoria(self, imsi: str, ubicacion: UbicacionEstimada):
         """Actualiza la trayectoria de un IMSI específico"""
         self.trayectorias[imsi].append(ubicacion)
-        
-        # Mantener solo las últimas 100 ubicaciones por IMSI
-        if len(self.trayectorias[imsi]) > 100:
-            self.trayectorias[imsi].pop(0)
     
     def generar_trayectoria_imsi(self, imsi: str) -> Dict:
         """Genera datos de trayectoria para un IMSI específico"""
@@ -424,7 +612,7 @@ class MapeadorGSM:
                     'coordinates': [ubicacion.longitude, ubicacion.latitude]
                 },
                 'properties': {
-                    'timestamp': ubicacion.timestamp.isoformat(),
+                    'timestamp': ubicacion.timestamp,
                     'precision': ubicacion.precision,
                     'orden': i
                 }
@@ -455,11 +643,31 @@ class MapeadorGSM:
 class AnalizadorGSMAvanzado:
     """Sistema completo de análisis GSM con triangulación"""
     
-    def __init__(self):
+    def __init__(self, intervalo_triangulacion: float = 0.5, umbral_lote: int = 8):
         self.triangulador = TrianguladorGSM()
         self.mapeador = MapeadorGSM(self.triangulador)
-        self.mediciones_actuales = defaultdict(list)
+        # Mediciones por IMSI en orden de llegada (ordenadas por timestamp)
+        self.mediciones_actuales = defaultdict(deque)
         self.ubicaciones_estimadas = []
+        self._ultima_limpieza = 0.0
+        
+        # Estadísticas de ubicaciones en arrays paralelos (crecen por duplicación)
+        self._num_estadisticas = 0
+        self._precisiones = np.empty(64, dtype=np.float64)
+        self._timestamps = np.empty(64, dtype='datetime64[us]')
+        self._metodos = np.empty(64, dtype=np.int8)
+        
+        # Triangulación diferida: se acumulan mediciones por IMSI y un hilo
+        # de trabajo resuelve cada IMSI como mucho una vez por intervalo,
+        # o antes si acumula `umbral_lote` mediciones nuevas
+        self.intervalo_triangulacion = intervalo_triangulacion
+        self.umbral_lote = umbral_lote
+        self.lock = threading.RLock()
+        self._pendientes: Set[str] = set()
+        self._mediciones_nuevas: Dict[str, int] = defaultdict(int)
+        self._ultimo_calculo: Dict[str, float] = {}
+        self._hay_pendientes = threading.Event()
+        threading.Thread(target=self._bucle_triangulacion, daemon=True).start()
         
         # Configurar logging
         logging.basicConfig(
@@ -471,60 +679,126 @@ class AnalizadorGSMAvanzado:
     def procesar_medicion_celda(self, imsi: str, celda: CeldaGSM):
         """Procesa una nueva medición de celda"""
         self.triangulador.agregar_medicion_celda(celda)
-        self.mediciones_actuales[imsi].append(celda)
         
-        # Realizar triangulación si tenemos suficientes mediciones
-        if len(self.mediciones_actuales[imsi]) >= 2:
-            ubicacion = self.triangulador.triangular_ubicacion(
-                self.mediciones_actuales[imsi]
-            )
+        with self.lock:
+            self.mediciones_actuales[imsi].append(celda)
+            
+            # Marcar para triangulación si tenemos suficientes mediciones
+            if len(self.mediciones_actuales[imsi]) >= 2:
+                self._pendientes.add(imsi)
+                self._mediciones_nuevas[imsi] += 1
+                if self._triangulacion_vencida(imsi, time.monotonic()):
+                    self._hay_pendientes.set()
+            
+            # Limpiar mediciones antiguas
+            self._limpiar_mediciones_antiguas()
+    
+    def _triangulacion_vencida(self, imsi: str, ahora: float) -> bool:
+        """Indica si un IMSI pendiente ya debe triangularse"""
+        return (self._mediciones_nuevas[imsi] >= self.umbral_lote or
+                ahora - self._ultimo_calculo.get(imsi, 0) > self.intervalo_triangulacion)
+    
+    def _bucle_triangulacion(self):
+        """Hilo de trabajo que vacía periódicamente los IMSI pendientes"""
+        while True:
+            self._hay_pendientes.wait(self.intervalo_triangulacion)
+            self._hay_pendientes.clear()
+            try:
+                self.procesar_pendientes()
+            except Exception as e:
+                self.logger.error(f"Error en triangulación diferida: {e}")
+    
+    def procesar_pendientes(self, forzar: bool = False):
+        """Triangula los IMSI pendientes cuyo intervalo ha vencido (o todos si `forzar`)"""
+        ahora = time.monotonic()
+        marca_tiempo = datetime.now()
+        with self.lock:
+            listos = [
+                imsi for imsi in self._pendientes
+                if forzar or self._triangulacion_vencida(imsi, ahora)
+            ]
+            lotes = []
+            for imsi in listos:
+                self._pendientes.discard(imsi)
+                self._mediciones_nuevas.pop(imsi, None)
+                self._ultimo_calculo[imsi] = ahora
+                lotes.append((imsi, list(self.mediciones_actuales[imsi])))
+        
+        for imsi, mediciones in lotes:
+            if len(mediciones) < 2:
+                continue
+            ubicacion = self.triangulador.triangular_ubicacion(mediciones, marca_tiempo)
             
             if ubicacion:
-                self.ubicaciones_estimadas.append(ubicacion)
-                self.mapeador.actualizar_trayectoria(imsi, ubicacion)
+                with self.lock:
+                    self.ubicaciones_estimadas.append(ubicacion)
+                    self._registrar_estadisticas(ubicacion)
+                    self.mapeador.actualizar_trayectoria(imsi, ubicacion)
                 
                 self.logger.info(
                     f"IMSI {imsi} ubicado en: "
                     f"Lat {ubicacion.latitude:.6f}, Lon {ubicacion.longitude:.6f}, "
                     f"Precisión: {ubicacion.precision:.2f} km"
                 )
-        
-        # Limpiar mediciones antiguas
-        self._limpiar_mediciones_antiguas()
     
     def _limpiar_mediciones_antiguas(self):
-        """Elimina mediciones más antiguas de 5 minutos"""
-        ahora = datetime.now()
-        for imsi in self.mediciones_actuales:
-            self.mediciones_actuales[imsi] = [
-                celda for celda in self.mediciones_actuales[imsi]
-                if (ahora - celda.timestamp) < timedelta(minutes=5)
-            ]
+        """Elimina mediciones más antiguas de 5 minutos (como mucho una vez por segundo)"""
+        ahora_monotonico = time.monotonic()
+        if ahora_monotonico - self._ultima_limpieza < 1.0:
+            return
+        self._ultima_limpieza = ahora_monotonico
+        
+        # Las colas están ordenadas por llegada: basta con recortar por la izquierda
+        limite = datetime.now() - timedelta(minutes=5)
+        for mediciones in self.mediciones_actuales.values():
+            while mediciones and mediciones[0].timestamp <= limite:
+                mediciones.popleft()
+    
+    def _registrar_estadisticas(self, ubicacion: UbicacionEstimada):
+        """Añade una ubicación a los arrays de estadísticas"""
+        n = self._num_estadisticas
+        if n == len(self._precisiones):
+            capacidad = 2 * n
+            for nombre in ('_precisiones', '_timestamps', '_metodos'):
+                anterior = getattr(self, nombre)
+                nuevo = np.empty(capacidad, dtype=anterior.dtype)
+                nuevo[:n] = anterior
+                setattr(self, nombre, nuevo)
+        
+        self._precisiones[n] = ubicacion.precision
+        self._timestamps[n] = np.datetime64(ubicacion.timestamp, 'us')
+        self._metodos[n] = CODIGOS_METODO[ubicacion.metodo]
+        self._num_estadisticas = n + 1
     
     def generar_reportes_ubicacion(self) -> Dict:
         """Genera reportes completos de ubicación"""
-        return {
-            'estadisticas_ubicacion': {
-                'total_ubicaciones': len(self.ubicaciones_estimadas),
-                'ubicaciones_hoy': len([
-                    u for u in self.ubicaciones_estimadas
-                    if u.timestamp.date() == datetime.now().date()
-                ]),
-                'precision_promedio': np.mean([
-                    u.precision for u in self.ubicaciones_estimadas[-100:]
-                ]) if self.ubicaciones_estimadas else 0,
-                'metodos_utilizados': defaultdict(int, [
-                    (u.metodo, 1) for u in self.ubicaciones_estimadas
-                ])
-            },
-            'mapa_heatmap': self.mapeador.generar_mapa_heatmap(
-                self.ubicaciones_estimadas[-1000:]  # Últimas 1000 ubicaciones
-            ),
-            'mapa_celdas': self.mapeador.generar_mapa_celdas(),
-            'imsi_activos': {
+        hoy = np.datetime64(datetime.now().date(), 'us')
+        with self.lock:
+            n = self._num_estadisticas
+            estadisticas = {
+                'total_ubicaciones': n,
+                'ubicaciones_hoy': int(np.count_nonzero(self._timestamps[:n] >= hoy)),
+                'precision_promedio': float(self._precisiones[max(0, n - 100):n].mean()) if n else 0,
+                'metodos_utilizados': {
+                    metodo: int(conteo)
+                    for metodo, conteo in zip(
+                        METODOS_UBICACION,
+                        np.bincount(self._metodos[:n], minlength=len(METODOS_UBICACION))
+                    ) if conteo
+                }
+            }
+            # Copias tomadas bajo el cerrojo: el hilo de procesamiento sigue añadiendo trayectorias
+            ultimas_ubicaciones = self.ubicaciones_estimadas[-1000:]  # Últimas 1000 ubicaciones
+            imsi_activos = {
                 imsi: len(trayectoria) 
                 for imsi, trayectoria in self.mapeador.trayectorias.items()
             }
+        
+        return {
+            'estadisticas_ubicacion': estadisticas,
+            'mapa_heatmap': self.mapeador.generar_mapa_heatmap(ultimas_ubicaciones),
+            'mapa_celdas': self.mapeador.generar_mapa_celdas(),
+            'imsi_activos': imsi_activos
         }
 
 # Integración con el sistema existente
@@ -572,14 +846,14 @@ def main():
         
         print("📡 Capturando tráfico GSM para triangulación...")
         
-        if opciones.exportar_mapa:
+        if opciones.archivo_mapa:
             # Exportar mapa periódicamente
             def exportar_periodicamente():
                 while True:
                     time.sleep(300)  # Cada 5 minutos
                     reporte = analizador.generar_reportes_ubicacion()
-                    with open(opciones.exportar_mapa, 'w') as f:
-                        json.dump(reporte, f, indent=2)
+                    with open(opciones.archivo_mapa, 'wb') as f:
+                        f.write(serializar_json(reporte))
                     print("🗺️ Mapa exportado")
             
             threading.Thread(target=exportar_periodicamente, daemon=True).start()
@@ -591,6 +865,7 @@ def main():
                   store=0)
         except KeyboardInterrupt:
             print("\n📊 Generando reporte final de triangulación...")
+            analizador.procesar_pendientes(forzar=True)
             reporte_final = analizador.generar_reportes_ubicacion()
             print("✅ Triangulación completada")
 
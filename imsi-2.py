@@ -2,13 +2,35 @@
 
 import sys
 orig_stdout = sys.stdout
-from scapy.all import sniff
 import json
+import ctypes
+import socket
+import struct
 from optparse import OptionParser
 
+import os
+import mmap
+import select
 import time
-
-imsis=[] 
+import io
+import atexit
+import threading
+from functools import lru_cache
+
+try:
+	import numpy as np
+	from numba import njit
+	NUMBA_AVAILABLE=True
+except ImportError:
+	NUMBA_AVAILABLE=False
+
+	def njit(*args, **kwargs):
+		"""No-op stand-in when numba is not installed"""
+		if len(args) == 1 and callable(args[0]) and not kwargs:
+			return args[0]
+		return lambda function: function
+
+imsis=set()
 tmsis={} 
 nb_IMSI=0
 mcc=""
@@ -18,59 +40,62 @@ cell=""
 country=""
 brand=""
 operator=""
+# Known (MCC, MNC) pairs split by MNC length, filled once the MCC table is loaded
+mnc2=set()
+mnc3=set()
+
+
+# Nibble swap table: the IMSI digits are BCD-coded with the low nibble first
+NIBSWAP=bytes(((b<<4)|(b>>4))&0xff for b in range(256))
 
 
 def str_tmsi(tmsi):
-	if tmsi != "":
-		new_tmsi="0x"
-		for a in tmsi:
-			c=hex(ord(a))
-			if len(c)==4:
-				new_tmsi+=str(c[2])+str(c[3])
-			else:
-				new_tmsi+="0"+str(c[2])
-		return new_tmsi
+	if tmsi:
+		return "0x"+tmsi.hex()
 	else:
 		return ""
 
-def str_imsi(imsi, p=""):
-	new_imsi=''
-	for a in imsi:
-		c=hex(ord(a))
-		if len(c)==4:
-			new_imsi+=str(c[3])+str(c[2])
-		else:
-			new_imsi+=str(c[2])+"0"
-	
-	mcc=new_imsi[1:4]
-	mnc=new_imsi[4:6]
+@lru_cache(maxsize=1024)
+def resolve_operator(mcc, mnc, next_digit):
+	"""
+	MNC length and "Country ; Brand ; Operator" columns for an IMSI prefix,
+	cached since only a handful of networks are seen from one place
+	Returns (mnc, columns), mnc is None when the MCC is unknown
+	"""
 	country=""
 	brand=""
 	operator=""
 	if mcc in mcc_codes:
-		if mnc in mcc_codes[mcc]['MNC']:
-			country=mcc_codes[mcc]['c'][0]
+		country=mcc_codes[mcc]['c'][0]
+		if (mcc, mnc) in mnc2:
 			brand=mcc_codes[mcc]['MNC'][mnc][0]
 			operator=mcc_codes[mcc]['MNC'][mnc][1]
-			new_imsi=mcc+" "+mnc+" "+new_imsi[6:]
-		elif mnc+new_imsi[6:7] in mcc_codes[mcc]['MNC']:
-			mnc+=new_imsi[6:7]
-			country=mcc_codes[mcc]['c'][0]
+		elif (mcc, mnc+next_digit) in mnc3:
+			mnc+=next_digit
 			brand=mcc_codes[mcc]['MNC'][mnc][0]
 			operator=mcc_codes[mcc]['MNC'][mnc][1]
-			new_imsi=mcc+" "+mnc+" "+new_imsi[7:]
 		else:
-			country=mcc_codes[mcc]['c'][0]
 			brand="Unknown MNC {}".format(mnc)
 			operator="Unknown MNC {}".format(mnc)
-			new_imsi=mcc+" "+mnc+" "+new_imsi[6:]
+	else:
+		mnc=None
+	return mnc, "{:12s} ; {:10s} ; {:21s}".format(country, brand, operator)
 
-	try:
-		m="{:17s} ; {:12s} ; {:10s} ; {:21s}".format(new_imsi, country.encode('utf-8'), brand.encode('utf-8'), operator.encode('utf-8'))
-	except:
-		m=""
-		print("Error", p, new_imsi, country, brand, operator)
-	return m
+def str_imsi(imsi):
+	new_imsi=imsi.translate(NIBSWAP).hex()
+	mcc=new_imsi[1:4]
+	mnc, columns=resolve_operator(mcc, new_imsi[4:6], new_imsi[6:7])
+	if mnc is not None:
+		new_imsi=mcc+" "+mnc+" "+new_imsi[4+len(mnc):]
+	return "{:17s} ; {}".format(new_imsi, columns)
+
+
+def imsi_key(field):
+	# IMSI/TMSI kept as integers: a small int hashes and compares faster and takes less memory than bytes
+	return int.from_bytes(field, 'little')
+
+def imsi_bytes(key):
+	return key.to_bytes(8, 'little') if key else b""
 
 
 def show_imsi(imsi1="", imsi2="", tmsi1="", tmsi2="", p=""):
@@ -85,63 +110,66 @@ def show_imsi(imsi1="", imsi2="", tmsi1="", tmsi2="", p=""):
 
 	do_print=False
 	n=''
-	if imsi1 and (not imsi_to_track or imsi1[:imsi_to_track_len] == imsi_to_track):
-		if imsi1 not in imsis:
+	t1=imsi_key(tmsi1)
+	t2=imsi_key(tmsi2)
+	if imsi1 and (imsi_to_track is None or imsi1.startswith(imsi_to_track)):
+		i1=imsi_key(imsi1)
+		if i1 not in imsis:
 			do_print=True
-			imsis.append(imsi1)
+			imsis.add(i1)
 			nb_IMSI+=1
 			n=nb_IMSI
-		if tmsi1 and (tmsi1 not in tmsis or tmsis[tmsi1] != imsi1):
+		if tmsi1 and tmsis.get(t1) != i1:
 			do_print=True
-			tmsis[tmsi1]=imsi1
-		if tmsi2 and (tmsi2 not in tmsis or tmsis[tmsi2] != imsi1):
+			tmsis[t1]=i1
+		if tmsi2 and tmsis.get(t2) != i1:
 			do_print=True
-			tmsis[tmsi2]=imsi1		
+			tmsis[t2]=i1
 	
-	if imsi2 and (not imsi_to_track or imsi2[:imsi_to_track_len] == imsi_to_track):
-		if imsi2 not in imsis:
+	if imsi2 and (imsi_to_track is None or imsi2.startswith(imsi_to_track)):
+		i2=imsi_key(imsi2)
+		if i2 not in imsis:
 			do_print=True
-			imsis.append(imsi2)
+			imsis.add(i2)
 			nb_IMSI+=1
 			n=nb_IMSI
-		if tmsi1 and (tmsi1 not in tmsis or tmsis[tmsi1] != imsi2):
+		if tmsi1 and tmsis.get(t1) != i2:
 			do_print=True
-			tmsis[tmsi1]=imsi2
-		if tmsi2 and (tmsi2 not in tmsis or tmsis[tmsi2] != imsi2):
+			tmsis[t1]=i2
+		if tmsi2 and tmsis.get(t2) != i2:
 			do_print=True
-			tmsis[tmsi2]=imsi2
+			tmsis[t2]=i2
 
 	if not imsi1 and not imsi2 and tmsi1 and tmsi2:
-		if tmsi2 in tmsis:
+		if t2 in tmsis:
 			do_print=True
-			imsi1=tmsis[tmsi2]
-			tmsis[tmsi1]=imsi1
-			del tmsis[tmsi2]
+			key=tmsis[t2]
+			tmsis[t1]=key
+			del tmsis[t2]
+			imsi1=imsi_bytes(key)
 
 	if do_print:
 		if imsi1:
-			sys.stdout.write("{:7s} ; {:10s} ; {:10s} ; {} ; {:4s} ; {:5s} ; {:6s} ; {:6s}\n".format(str(n), str_tmsi(tmsi1), str_tmsi(tmsi2), str_imsi(imsi1, p), str(mcc), str(mnc), str(lac), str(cell)))
-			sys.stdout.flush()
+			sys.stdout.write("{:7s} ; {:10s} ; {:10s} ; {} ; {:4s} ; {:5s} ; {:6s} ; {:6s}\n".format(str(n), str_tmsi(tmsi1), str_tmsi(tmsi2), str_imsi(imsi1), str(mcc), str(mnc), str(lac), str(cell)))
 		if imsi2:
-			sys.stdout.write("{:7s} ; {:10s} ; {:10s} ; {} ; {:4s} ; {:5s} ; {:6s} ; {:6s}\n".format(str(n), str_tmsi(tmsi1), str_tmsi(tmsi2), str_imsi(imsi1, p), str(mcc), str(mnc), str(lac), str(cell)))
-			sys.stdout.flush()
-			#print("{:7s} ; {:10s} ; {:10s} ; {} ; {:4s} ; {:5s} ; {:6s} ; {:6s}".format(str(n), str_tmsi(tmsi1), str_tmsi(tmsi2), str_imsi(imsi2, p), str(mcc), str(mnc), str(lac), str(cell)))
+			sys.stdout.write("{:7s} ; {:10s} ; {:10s} ; {} ; {:4s} ; {:5s} ; {:6s} ; {:6s}\n".format(str(n), str_tmsi(tmsi1), str_tmsi(tmsi2), str_imsi(imsi1), str(mcc), str(mnc), str(lac), str(cell)))
+			#print("{:7s} ; {:10s} ; {:10s} ; {} ; {:4s} ; {:5s} ; {:6s} ; {:6s}".format(str(n), str_tmsi(tmsi1), str_tmsi(tmsi2), str_imsi(imsi2), str(mcc), str(mnc), str(lac), str(cell)))
 
 	if not imsi1 and not imsi2 and show_all_tmsi:
 		do_print=False
-		if tmsi1 and tmsi1 not in tmsis:
+		if tmsi1 and t1 not in tmsis:
 			do_print=True
-			tmsis[tmsi1]=""
-		if tmsi1 and tmsi1 not in tmsis:
+			tmsis[t1]=0
+		if tmsi1 and t1 not in tmsis:
 			do_print=True
-			tmsis[tmsi2]=""
+			tmsis[t2]=0
 		if do_print:			
-			#sys.stdout.write("{:7s} ; {:10s} ; {:10s} ; {} ; {:4s} ; {:5s} ; {:6s} ; {:6s}\n".format(str(n), str_tmsi(tmsi1), str_tmsi(tmsi2), str_imsi(imsi1, p), str(mcc), str(mnc), str(lac), str(cell)))
-			sys.stdout.flush()
+			#sys.stdout.write("{:7s} ; {:10s} ; {:10s} ; {} ; {:4s} ; {:5s} ; {:6s} ; {:6s}\n".format(str(n), str_tmsi(tmsi1), str_tmsi(tmsi2), str_imsi(imsi1), str(mcc), str(mnc), str(lac), str(cell)))
+			pass
 			#print("{:7s} ; {:10s} ; {:10s} ; {:17s} ; {:12s} ; {:10s} ; {:21s} ; {:4s} ; {:5s} ; {:6s} ; {:6s}\n".format(str(n), str_tmsi(tmsi1), str_tmsi(tmsi2), "", "", "", "", str(mcc), str(mnc), str(lac), str(cell)))
 
 
-def find_cell(x):
+def find_cell(p):
 	global mcc
 	global mnc
 	global lac
@@ -179,153 +207,339 @@ def find_cell(x):
 	0030                                                02 
 	0040   f8 02 01 9c
 	"""
-	p=str(x)
-	if ord(p[0x36]) == 0x01: 
-		if ord(p[0x3c]) == 0x1b: 
-			m=hex(ord(p[0x3f]))
-			if len(m)<4:
-				mcc=m[2]+'0'
-			else:
-				mcc=m[3]+m[2]
-			mcc+=str(ord(p[0x40]) & 0x0f)
-			m=hex(ord(p[0x41]))
-			if len(m)<4:
-				mnc=m[2]+'0'
-			else:
-				mnc=m[3]+m[2]
-
-			lac=ord(p[0x42])*256+ord(p[0x43])
-			cell=ord(p[0x3d])*256+ord(p[0x3e])
-			brand=""
-			operator=""
-			if mcc in mcc_codes:
-				if mnc in mcc_codes[mcc]['MNC']:
-					country=mcc_codes[mcc]['c'][0]
-					brand=mcc_codes[mcc]['MNC'][mnc][0]
-					operator=mcc_codes[mcc]['MNC'][mnc][1]
-				else:
-					country=mcc_codes[mcc]['c'][0]
-					brand="Unknown MNC {}".format(mnc)
-					operator="Unknown MNC {}".format(mnc)
-			else:
-				country="Unknown MCC {}".format(mcc)
-				brand="Unknown MNC {}".format(mnc)
-				operator="Unknown MNC {}".format(mnc)
-			mcc=str(mcc)
-			mnc=str(mnc)
-			lac=str(lac)
-			cell=str(cell)
-			country=country.encode('utf-8')
-			brand=brand.encode('utf-8')
-			operator= operator.encode('utf-8')
-			return mcc, mnc, lac, cell, country, brand, operator
-	return None, None, None, None, None, None, None
+	mcc=p[0x3f:0x40].translate(NIBSWAP).hex()+str(p[0x40] & 0x0f)
+	mnc=p[0x41:0x42].translate(NIBSWAP).hex()
+
+	lac=p[0x42]*256+p[0x43]
+	cell=p[0x3d]*256+p[0x3e]
+	brand=""
+	operator=""
+	if mcc in mcc_codes:
+		if mnc in mcc_codes[mcc]['MNC']:
+			country=mcc_codes[mcc]['c'][0]
+			brand=mcc_codes[mcc]['MNC'][mnc][0]
+			operator=mcc_codes[mcc]['MNC'][mnc][1]
+		else:
+			country=mcc_codes[mcc]['c'][0]
+			brand="Unknown MNC {}".format(mnc)
+			operator="Unknown MNC {}".format(mnc)
+	else:
+		country="Unknown MCC {}".format(mcc)
+		brand="Unknown MNC {}".format(mnc)
+		operator="Unknown MNC {}".format(mnc)
+	mcc=str(mcc)
+	mnc=str(mnc)
+	lac=str(lac)
+	cell=str(cell)
+	country=country.encode('utf-8')
+	brand=brand.encode('utf-8')
+	operator= operator.encode('utf-8')
+	return mcc, mnc, lac, cell, country, brand, operator
+
+
+def flush_periodically(interval=1.0):
+	while True:
+		time.sleep(interval)
+		sys.stdout.flush()
+
+
+ETH_P_ALL=0x0003
+SO_ATTACH_FILTER=26
+SOL_PACKET=263
+PACKET_FANOUT=18
+PACKET_FANOUT_LB=1
+PACKET_RX_RING=5
+PACKET_VERSION=10
+TPACKET_V3=2
+TP_STATUS_KERNEL=0
+TP_STATUS_USER=1
+
+# PACKET_MMAP receive ring: 64 blocks of 64 KiB, a block is handed over when full or after 100 ms
+RING_BLOCK_SIZE=1<<16
+RING_BLOCK_NR=64
+RING_FRAME_SIZE=2048
+RING_BLOCK_TIMEOUT_MS=100
+# struct tpacket3_hdr is 48 bytes, struct sockaddr_ll follows with sll_pkttype at offset 10
+TPACKET3_PKTTYPE=48+10
+
+# Serializes show_imsi/find_cell and their globals when several capture threads run
+state_lock=threading.Lock()
+
+
+def udp_port_filter(port):
+	"""
+	Classic BPF program equivalent to "udp port <port>" on IPv4 over Ethernet
+	(tcpdump -dd output), so the kernel drops everything else
+	"""
+	return [
+		(0x28, 0, 0, 12),         # ldh [12]               ethertype
+		(0x15, 0, 10, 0x0800),    # jeq #0x800             IPv4
+		(0x30, 0, 0, 23),         # ldb [23]               protocol
+		(0x15, 0, 8, 17),         # jeq #17                UDP
+		(0x28, 0, 0, 20),         # ldh [20]               flags + fragment offset
+		(0x45, 6, 0, 0x1fff),     # jset #0x1fff           skip fragments
+		(0xb1, 0, 0, 14),         # ldxb 4*([14]&0xf)      IP header length
+		(0x48, 0, 0, 14),         # ldh [x+14]             source port
+		(0x15, 2, 0, port),       # jeq #port
+		(0x48, 0, 0, 16),         # ldh [x+16]             destination port
+		(0x15, 0, 1, port),       # jeq #port
+		(0x06, 0, 0, 0x40000),    # ret #262144            accept
+		(0x06, 0, 0, 0),          # ret #0                 drop
+	]
+
+
+def open_capture(iface, port, fanout_group=None):
+	# Protocol 0 receives nothing until bind(), so no packet gets queued before the filter is attached
+	s=socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+	program=udp_port_filter(port)
+	instructions=ctypes.create_string_buffer(b"".join(struct.pack("HBBI", *i) for i in program))
+	s.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, struct.pack("HL", len(program), ctypes.addressof(instructions)))
+	s.bind((iface, ETH_P_ALL))
+	if fanout_group is not None:
+		# Round-robin rather than flow hash: gr-gsm sends everything as a single UDP flow
+		s.setsockopt(SOL_PACKET, PACKET_FANOUT, fanout_group | (PACKET_FANOUT_LB << 16))
+	return s
+
+
+def capture(iface, port, threads=1):
+	"""
+	Read the capture with one or more threads. With threads > 1 the packets of the
+	GSMTAP flow are spread round-robin, so they are no longer handled in arrival order:
+	a line may carry the cell of a neighbouring SI3 and TMSI reallocations may be missed
+	"""
+	if threads == 1:
+		read_packets(open_capture(iface, port))
+		return
+
+	# PACKET_FANOUT: the kernel spreads the packets over one socket per thread
+	sys.stderr.write("Warning: with %d capture threads packets are processed out of order (cell info and TMSI reallocations may be wrong)\n" % threads)
+	fanout_group=os.getpid() & 0xffff
+	sockets=[open_capture(iface, port, fanout_group) for _ in range(threads)]
+	workers=[threading.Thread(target=read_packets, args=(s,), daemon=True) for s in sockets]
+	for w in workers:
+		w.start()
+	for w in workers:
+		w.join()
+
+
+def map_rx_ring(s):
+	s.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+	frame_nr=RING_BLOCK_SIZE*RING_BLOCK_NR//RING_FRAME_SIZE
+	# struct tpacket_req3
+	s.setsockopt(SOL_PACKET, PACKET_RX_RING, struct.pack("IIIIIII", RING_BLOCK_SIZE, RING_BLOCK_NR, RING_FRAME_SIZE, frame_nr, RING_BLOCK_TIMEOUT_MS, 0, 0))
+	return mmap.mmap(s.fileno(), RING_BLOCK_SIZE*RING_BLOCK_NR, mmap.MAP_SHARED, mmap.PROT_READ|mmap.PROT_WRITE)
+
+
+def read_packets(s):
+	try:
+		ring=map_rx_ring(s)
+	except OSError:
+		# No TPACKET_V3 (Linux < 3.2): one recvfrom per packet
+		read_packets_recvfrom(s)
+	else:
+		read_packets_ring(s, ring)
 
 
-def find_imsi(x):
-	find_cell(x)
-	p=str(x)
-	if ord(p[0x36]) != 0x1:
-		tmsi1=""
-		tmsi2=""
-		imsi1=""
-		imsi2=""
-		if ord(p[0x3c]) == 0x21: 
-			if ord(p[0x3e]) == 0x08 and (ord(p[0x3f]) & 0x1) == 0x1: 
+def read_packets_ring(s, ring):
+	"""
+	Walk the blocks of the PACKET_MMAP ring as the kernel fills them: no syscall per
+	packet, and each frame reaches find_imsi as a zero-copy memoryview into the ring
+	"""
+	view=memoryview(ring)
+	poller=select.poll()
+	poller.register(s, select.POLLIN|select.POLLERR)
+	block=0
+	while True:
+		start=block*RING_BLOCK_SIZE
+		# struct tpacket_block_desc: version, offset_to_priv, then block_status, num_pkts, offset_to_first_pkt
+		status, num_pkts, offset=struct.unpack_from("III", ring, start+8)
+		if not status & TP_STATUS_USER:
+			poller.poll()
+			continue
+
+		packet=start+offset
+		for _ in range(num_pkts):
+			# struct tpacket3_hdr: tp_next_offset, tp_sec, tp_nsec, tp_snaplen ... tp_mac at 24
+			next_offset, _, _, snaplen=struct.unpack_from("IIII", ring, packet)
+			mac,=struct.unpack_from("H", ring, packet+24)
+			# On lo every packet is seen twice, going out and coming in
+			if ring[packet+TPACKET3_PKTTYPE] != socket.PACKET_OUTGOING:
+				find_imsi(view[packet+mac:packet+mac+snaplen])
+			packet+=next_offset
+
+		# Hand the block back to the kernel
+		struct.pack_into("I", ring, start+8, TP_STATUS_KERNEL)
+		block=(block+1)%RING_BLOCK_NR
+
+
+def read_packets_recvfrom(s):
+	while True:
+		buf, addr=s.recvfrom(65535)
+		# On lo every packet is seen twice, going out and coming in
+		if addr[2] != socket.PACKET_OUTGOING:
+			find_imsi(buf)
+
+
+# Packet layouts recognised by parse_gsmtap, used as indexes into DISPATCH
+NO_MATCH=0
+SYSTEM_INFO_3=1
+PAGING_IMSI_IMSI=2
+PAGING_IMSI_TMSI=3
+PAGING_IMSI=4
+PAGING_TMSI_IMSI=5
+PAGING_TMSI_TMSI=6
+PAGING_TMSI=7
+PAGING_TMSI_TMSI_IMSI=8
+
+
+@njit(cache=True, nogil=True)
+def parse_gsmtap(buf):
+	"""
+	Identify the layout of a GSMTAP packet (uint8 buffer), one of the constants above
+	"""
+	if len(buf) < 0x4a:
+		return NO_MATCH
+	if buf[0x36] == 0x01:
+		if buf[0x3c] == 0x1b:
+			return SYSTEM_INFO_3
+		return NO_MATCH
+
+	if buf[0x3c] == 0x21:
+		if buf[0x3e] == 0x08 and (buf[0x3f] & 0x1) == 0x1:
+			"""
+			        0  1  2  3  4  5  6  7  8  9  a  b  c  d  e  f
+			0000   00 00 00 00 00 00 00 00 00 00 00 00 08 00 45 00
+			0010   00 43 1c d4 40 00 40 11 1f d4 7f 00 00 01 7f 00
+			0020   00 01 c2 e4 12 79 00 2f fe 42 02 04 01 00 00 00
+			0030   c9 00 00 16 21 26 02 00 07 00 31 06 21 00 08 XX
+			0040   XX XX XX XX XX XX XX 2b 2b 2b 2b 2b 2b 2b 2b 2b
+			0050   2b
+			XX XX XX XX XX XX XX XX = IMSI
+			"""
+			if buf[0x3a] == 0x59 and buf[0x48] == 0x08 and (buf[0x49] & 0x1) == 0x1:
 				"""
-				        0  1  2  3  4  5  6  7  8  9  a  b  c  d  e  f
-				0000   00 00 00 00 00 00 00 00 00 00 00 00 08 00 45 00
-				0010   00 43 1c d4 40 00 40 11 1f d4 7f 00 00 01 7f 00
-				0020   00 01 c2 e4 12 79 00 2f fe 42 02 04 01 00 00 00
-				0030   c9 00 00 16 21 26 02 00 07 00 31 06 21 00 08 XX
-				0040   XX XX XX XX XX XX XX 2b 2b 2b 2b 2b 2b 2b 2b 2b
-				0050   2b
-				XX XX XX XX XX XX XX XX = IMSI
+			        0  1  2  3  4  5  6  7  8  9  a  b  c  d  e  f
+			0000   00 00 00 00 00 00 00 00 00 00 00 00 08 00 45 00
+			0010   00 43 90 95 40 00 40 11 ac 12 7f 00 00 01 7f 00
+			0020   00 01 b4 1c 12 79 00 2f fe 42 02 04 01 00 00 00
+			0030   c8 00 00 16 51 c6 02 00 08 00 59 06 21 00 08 YY
+			0040   YY YY YY YY YY YY YY 17 08 XX XX XX XX XX XX XX
+			0050   XX
+			YY YY YY YY YY YY YY YY = IMSI 1
+			XX XX XX XX XX XX XX XX = IMSI 2
 				"""
-				imsi1=p[0x3f:][:8]
-				if ord(p[0x3a]) == 0x59 and ord(p[0x48]) == 0x08 and (ord(p[0x49]) & 0x1) == 0x1:
-					"""
-				        0  1  2  3  4  5  6  7  8  9  a  b  c  d  e  f
-				0000   00 00 00 00 00 00 00 00 00 00 00 00 08 00 45 00
-				0010   00 43 90 95 40 00 40 11 ac 12 7f 00 00 01 7f 00
-				0020   00 01 b4 1c 12 79 00 2f fe 42 02 04 01 00 00 00
-				0030   c8 00 00 16 51 c6 02 00 08 00 59 06 21 00 08 YY
-				0040   YY YY YY YY YY YY YY 17 08 XX XX XX XX XX XX XX
-				0050   XX
-				YY YY YY YY YY YY YY YY = IMSI 1
-				XX XX XX XX XX XX XX XX = IMSI 2
-					"""
-					imsi2=p[0x49:][:8]
-				elif ord(p[0x3a]) == 0x59 and ord(p[0x48]) == 0x08 and (ord(p[0x49]) & 0x1) == 0x1: 
-					"""
-				        0  1  2  3  4  5  6  7  8  9  a  b  c  d  e  f
-				0000   00 00 00 00 00 00 00 00 00 00 00 00 08 00 45 00
-				0010   00 43 f6 92 40 00 40 11 46 15 7f 00 00 01 7f 00
-				0020   00 01 ab c1 12 79 00 2f fe 42 02 04 01 00 00 00
-				0030   d8 00 00 23 3e be 02 00 05 00 4d 06 21 a0 08 YY
-				0040   YY YY YY YY YY YY YY 17 05 f4 XX XX XX XX 2b 2b
-				0050   2b
-				YY YY YY YY YY YY YY YY = IMSI 1
-				XX XX XX XX = TMSI
-					"""
-					tmsi1=p[0x4a:][:4]
-
-				show_imsi(imsi1, imsi2, tmsi1, tmsi2, p)
-
-			elif ord(p[0x45]) == 0x08 and (ord(p[0x46]) & 0x1) == 0x1: 
+				return PAGING_IMSI_IMSI
+			elif buf[0x3a] == 0x59 and buf[0x48] == 0x08 and (buf[0x49] & 0x1) == 0x1:
 				"""
-				        0  1  2  3  4  5  6  7  8  9  a  b  c  d  e  f
-				0000   00 00 00 00 00 00 00 00 00 00 00 00 08 00 45 00
-				0010   00 43 57 8e 40 00 40 11 e5 19 7f 00 00 01 7f 00
-				0020   00 01 99 d4 12 79 00 2f fe 42 02 04 01 00 00 00
-				0030   c7 00 00 11 05 99 02 00 03 00 4d 06 21 00 05 f4
-				0040   yy yy yy yy 17 08 XX XX XX XX XX XX XX XX 2b 2b
-				0050   2b
-				yy yy yy yy = TMSI/P-TMSI - Mobile Identity 1
-				XX XX XX XX XX XX XX XX = IMSI
+			        0  1  2  3  4  5  6  7  8  9  a  b  c  d  e  f
+			0000   00 00 00 00 00 00 00 00 00 00 00 00 08 00 45 00
+			0010   00 43 f6 92 40 00 40 11 46 15 7f 00 00 01 7f 00
+			0020   00 01 ab c1 12 79 00 2f fe 42 02 04 01 00 00 00
+			0030   d8 00 00 23 3e be 02 00 05 00 4d 06 21 a0 08 YY
+			0040   YY YY YY YY YY YY YY 17 05 f4 XX XX XX XX 2b 2b
+			0050   2b
+			YY YY YY YY YY YY YY YY = IMSI 1
+			XX XX XX XX = TMSI
 				"""
-				tmsi1=p[0x40:][:4]
-				imsi2=p[0x46:][:8]
-				show_imsi(imsi1, imsi2, tmsi1, tmsi2, p)
+				return PAGING_IMSI_TMSI
+			return PAGING_IMSI
+
+		elif buf[0x45] == 0x08 and (buf[0x46] & 0x1) == 0x1:
+			"""
+			        0  1  2  3  4  5  6  7  8  9  a  b  c  d  e  f
+			0000   00 00 00 00 00 00 00 00 00 00 00 00 08 00 45 00
+			0010   00 43 57 8e 40 00 40 11 e5 19 7f 00 00 01 7f 00
+			0020   00 01 99 d4 12 79 00 2f fe 42 02 04 01 00 00 00
+			0030   c7 00 00 11 05 99 02 00 03 00 4d 06 21 00 05 f4
+			0040   yy yy yy yy 17 08 XX XX XX XX XX XX XX XX 2b 2b
+			0050   2b
+			yy yy yy yy = TMSI/P-TMSI - Mobile Identity 1
+			XX XX XX XX XX XX XX XX = IMSI
+			"""
+			return PAGING_TMSI_IMSI
+
+		elif buf[0x3e] == 0x05 and (buf[0x3f] & 0x07) == 4:
+			"""
+			        0  1  2  3  4  5  6  7  8  9  a  b  c  d  e  f
+			0000   00 00 00 00 00 00 00 00 00 00 00 00 08 00 45 00
+			0010   00 43 b3 f7 40 00 40 11 88 b0 7f 00 00 01 7f 00
+			0020   00 01 ce 50 12 79 00 2f fe 42 02 04 01 00 03 fd
+			0030   d1 00 00 1b 03 5e 05 00 00 00 41 06 21 00 05 f4
+			0040   XX XX XX XX 17 05 f4 YY YY YY YY 2b 2b 2b 2b 2b
+			0050   2b
+			XX XX XX XX = TMSI/P-TMSI - Mobile Identity 1
+			YY YY YY YY = TMSI/P-TMSI - Mobile Identity 2
+			"""
+			if buf[0x45] == 0x05 and (buf[0x46] & 0x07) == 4:
+				return PAGING_TMSI_TMSI
+			return PAGING_TMSI
+
+	elif buf[0x3c] == 0x22:
+		if buf[0x47] == 0x08 and (buf[0x48] & 0x1) == 0x1:
+			"""
+			        0  1  2  3  4  5  6  7  8  9  a  b  c  d  e  f				
+			0000   00 00 00 00 00 00 00 00 00 00 00 00 08 00 45 00
+			0010   00 43 1c a6 40 00 40 11 20 02 7f 00 00 01 7f 00
+			0020   00 01 c2 e4 12 79 00 2f fe 42 02 04 01 00 00 00
+			0030   c9 00 00 16 20 e3 02 00 04 00 55 06 22 00 yy yy
+			0040   yy yy zz zz zz 4e 17 08 XX XX XX XX XX XX XX XX
+			0050   8b
+			yy yy yy yy = TMSI/P-TMSI - Mobile Identity 1
+			zz zz zz zz = TMSI/P-TMSI - Mobile Identity 2
+			XX XX XX XX XX XX XX XX = IMSI
+			"""
+			return PAGING_TMSI_TMSI_IMSI
+
+	return NO_MATCH
+
+
+def paging_handler(imsi1, imsi2, tmsi1, tmsi2):
+	"""
+	Build the handler of one paging layout: the offsets (-1 = absent) are bound
+	once here, so the handler only slices the packet at fixed positions
+	"""
+	def field(offset, size):
+		if offset < 0:
+			return lambda p: b""
+		return lambda p: p[offset:offset+size]
 
-			elif ord(p[0x3e]) == 0x05 and (ord(p[0x3f]) & 0x07) == 4: 
-				"""
-				        0  1  2  3  4  5  6  7  8  9  a  b  c  d  e  f
-				0000   00 00 00 00 00 00 00 00 00 00 00 00 08 00 45 00
-				0010   00 43 b3 f7 40 00 40 11 88 b0 7f 00 00 01 7f 00
-				0020   00 01 ce 50 12 79 00 2f fe 42 02 04 01 00 03 fd
-				0030   d1 00 00 1b 03 5e 05 00 00 00 41 06 21 00 05 f4
-				0040   XX XX XX XX 17 05 f4 YY YY YY YY 2b 2b 2b 2b 2b
-				0050   2b
-				XX XX XX XX = TMSI/P-TMSI - Mobile Identity 1
-				YY YY YY YY = TMSI/P-TMSI - Mobile Identity 2
-				"""
-				tmsi1=p[0x40:][:4]
-				if ord(p[0x45]) == 0x05 and (ord(p[0x46]) & 0x07) == 4: 
-					tmsi2=p[0x47:][:4]
-				else:
-					tmsi2=""
+	get_imsi1, get_imsi2=field(imsi1, 8), field(imsi2, 8)
+	get_tmsi1, get_tmsi2=field(tmsi1, 4), field(tmsi2, 4)
 
-				show_imsi(imsi1, imsi2, tmsi1, tmsi2, p)
+	def handler(p):
+		show_imsi(get_imsi1(p), get_imsi2(p), get_tmsi1(p), get_tmsi2(p), p)
+	return handler
 
-		elif ord(p[0x3c]) == 0x22: 
-			if ord(p[0x47]) == 0x08 and (ord(p[0x48]) & 0x1) == 0x1: 
-				"""
-				        0  1  2  3  4  5  6  7  8  9  a  b  c  d  e  f				
-				0000   00 00 00 00 00 00 00 00 00 00 00 00 08 00 45 00
-				0010   00 43 1c a6 40 00 40 11 20 02 7f 00 00 01 7f 00
-				0020   00 01 c2 e4 12 79 00 2f fe 42 02 04 01 00 00 00
-				0030   c9 00 00 16 20 e3 02 00 04 00 55 06 22 00 yy yy
-				0040   yy yy zz zz zz 4e 17 08 XX XX XX XX XX XX XX XX
-				0050   8b
-				yy yy yy yy = TMSI/P-TMSI - Mobile Identity 1
-				zz zz zz zz = TMSI/P-TMSI - Mobile Identity 2
-				XX XX XX XX XX XX XX XX = IMSI
-				"""
-				tmsi1=p[0x3e:][:4]
-				tmsi2=p[0x42:][:4]
-				imsi2=p[0x48:][:8]
-				show_imsi(imsi1, imsi2, tmsi1, tmsi2, p)
+
+# Handler of each layout returned by parse_gsmtap, indexed by its constant
+DISPATCH=[None]*(PAGING_TMSI_TMSI_IMSI+1)
+DISPATCH[SYSTEM_INFO_3]=find_cell
+DISPATCH[PAGING_IMSI_IMSI]=paging_handler(0x3f, 0x49, -1, -1)
+DISPATCH[PAGING_IMSI_TMSI]=paging_handler(0x3f, -1, 0x4a, -1)
+DISPATCH[PAGING_IMSI]=paging_handler(0x3f, -1, -1, -1)
+DISPATCH[PAGING_TMSI_IMSI]=paging_handler(-1, 0x46, 0x40, -1)
+DISPATCH[PAGING_TMSI_TMSI]=paging_handler(-1, -1, 0x40, 0x47)
+DISPATCH[PAGING_TMSI]=paging_handler(-1, -1, 0x40, -1)
+DISPATCH[PAGING_TMSI_TMSI_IMSI]=paging_handler(-1, 0x48, 0x3e, 0x42)
+
+
+def find_imsi(x):
+	# x may be a memoryview into the capture ring: only copied out once something matched
+	if NUMBA_AVAILABLE:
+		handler=DISPATCH[parse_gsmtap(np.frombuffer(x, dtype=np.uint8))]
+	else:
+		handler=DISPATCH[parse_gsmtap(x)]
+	if handler is None:
+		return
+
+	p=bytes(x)
+	with state_lock:
+		handler(p)
+
+
+if NUMBA_AVAILABLE:
+	# Compile (or load from cache) the parser now rather than on the first packet
+	parse_gsmtap(np.zeros(0x51, dtype=np.uint8))
 
 
 if __name__ == '__main__':
@@ -334,17 +548,18 @@ if __name__ == '__main__':
 	parser.add_option("-i", "--iface", dest="iface", default="lo", help="Interface (default : lo)")
 	parser.add_option("-m", "--imsi", dest="imsi", default="", type="string", help='IMSI to track (default : None, Example: 123456789101112 or "123 45 6789101112")')
 	parser.add_option("-p", "--port", dest="port", default="4729", type="int", help="Port (default : 4729)")
+	parser.add_option("-t", "--threads", dest="threads", default="1", type="int", help="Capture threads, fed through PACKET_FANOUT; more than 1 loses packet order, so cell info and TMSI reallocations may be wrong (default : 1)")
 	(options, args) = parser.parse_args()
+	if options.threads < 1:
+		parser.error("--threads must be at least 1")
 
 	show_all_tmsi=options.show_all_tmsi
-	imsi_to_track=""
+	imsi_to_track=None
 	if options.imsi:
 		imsi="9"+options.imsi.replace(" ", "")
-		imsi_to_track_len=len(imsi)
-		if imsi_to_track_len%2 == 0 and imsi_to_track_len > 0 and imsi_to_track_len <17:
-			for i in range(0, imsi_to_track_len-1, 2):
-				imsi_to_track+=chr(int(imsi[i+1])*16+int(imsi[i]))
-			imsi_to_track_len=len(imsi_to_track)
+		if len(imsi)%2 == 0 and len(imsi) <17 and imsi.isdigit():
+			# Same nibble-swapped encoding as the IMSI bytes in the packet
+			imsi_to_track=bytes.fromhex(''.join(imsi[i+1]+imsi[i] for i in range(0, len(imsi)-1, 2)))
 		else:
 			print("Wrong size for the IMSI to track!")
 			print("Valid sizes :")
@@ -360,5 +575,15 @@ if __name__ == '__main__':
 
 	with open('mcc-mnc/mcc_codes.json', 'r') as file:
 		mcc_codes = json.load(file)
+	for code, entry in mcc_codes.items():
+		for network in entry['MNC']:
+			if len(network) == 2:
+				mnc2.add((code, network))
+			elif len(network) == 3:
+				mnc3.add((code, network))
+	# Block-buffered output: flushed every second and at exit rather than after each line
+	sys.stdout=io.TextIOWrapper(io.BufferedWriter(open(1, 'wb', buffering=0, closefd=False), buffer_size=65536), write_through=False)
+	atexit.register(sys.stdout.flush)
+	threading.Thread(target=flush_periodically, daemon=True).start()
 	sys.stdout.write("{:7s} ; {:10s} ; {:10s} ; {:17s} ; {:12s} ; {:10s} ; {:21s} ; {:5s} ; {:4s} ; {:5s} ; {:6s}".format("Nb IMSI", "T-IMSI1", "T-IMSI2", "IMSI", "Country", "Brand", "Operator", "MCC", "MNC", "LAC", "CellId"))
-	sniff(iface=options.iface, filter="port {} and not icmp and udp".format(options.port), prn=find_imsi, store=0)
+	capture(options.iface, options.port, options.threads)
@@ -6,20 +6,27 @@ import json
 import time
 import sqlite3
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime
 from collections import defaultdict, deque
+from contextlib import closing
+from itertools import islice
+from pathlib import Path
 from optparse import OptionParser
 from scapy.all import sniff, IP, UDP
 import threading
+import queue
 import heapq
 from dataclasses import dataclass
 from typing import Dict, List, Set, Optional, Tuple
 import csv
 import os
 
+# (país, marca, operador) cuando el par MCC/MNC no está en la tabla
+OPERADOR_DESCONOCIDO = ('Desconocido', 'Desconocido', 'Desconocido')
+
 @dataclass
 class EventoIMSI:
-    timestamp: datetime
+    timestamp: int  # time.monotonic_ns(): solo para aritmética de ventanas
     imsi: str
     tmsi: str
     tipo_evento: str  # 'DETECCION', 'REASIGNACION', 'ALERTA'
@@ -30,23 +37,54 @@ class EventoIMSI:
     fuerza_señal: Optional[int] = None
 
 class AnalizadorMovil:
+    VENTANA_REASIGNACIONES_NS = 300_000_000_000  # 5 minutos
+    # Texto fijo de las sentencias: sqlite3 las prepara una vez y las reutiliza
+    SQL_DETECCION = '''
+        INSERT INTO detecciones_imsi 
+        (imsi, tmsi, mcc, mnc, lac, cell_id, tipo_evento, pais, operador)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    '''
+    SQL_ALERTA = '''
+        INSERT INTO alertas (tipo_alerta, severidad, descripcion, imsi_involucrado)
+        VALUES (?, ?, ?, ?)
+    '''
+    # Escritura por lotes desde un único hilo escritor
+    LOTE_MAXIMO = 500
+    CAPACIDAD_COLA = 10000
+
     def __init__(self, archivo_bd: str = "trafico_movil.db"):
         self.imsis_detectados = set()
         self.tmsis_asociados = {}
         self.contador_imsi = 0
         self.estadisticas = defaultdict(lambda: defaultdict(int))
         self.alertas = []
+        # Conexión de escritura, usada solo por el hilo escritor; las consultas
+        # abren su propia conexión de solo lectura (ver conexion_lectura)
+        self.archivo_bd = archivo_bd
         self.conn = sqlite3.connect(archivo_bd, check_same_thread=False)
         self._inicializar_bd()
+        self._cursor_escritura = self.conn.cursor()
         self.lock = threading.RLock()
         
-        # Patrones sospechosos
-        self.reasignaciones_rapidas = defaultdict(deque)
+        # Filas (sentencia, valores) pendientes; solo el hilo escritor escribe en SQLite
+        self._cola_escritura = queue.Queue(self.CAPACIDAD_COLA)
+        
+        # Patrones sospechosos: ventana deslizante de 5 min compartida por todos
+        # los IMSI, un montículo de (caducidad, imsi) y un contador por IMSI activo
+        self._eventos_ventana = []
+        self.reasignaciones_rapidas = defaultdict(int)
         self.imsi_hopping = defaultdict(set)
         
         # Cargar códigos MCC-MNC
         with open('mcc-mnc/mcc_codes.json', 'r') as archivo:
             self.codigos_mcc_mnc = json.load(archivo)
+        # Índices planos: una búsqueda por (mcc, mnc) en lugar de tres anidadas
+        self.paises = {mcc: datos['c'][0] for mcc, datos in self.codigos_mcc_mnc.items()}
+        self.operadores = {
+            (mcc, mnc): (datos['c'][0], nombres[0], nombres[1])
+            for mcc, datos in self.codigos_mcc_mnc.items()
+            for mnc, nombres in datos['MNC'].items()
+        }
         
         # Configurar logging
         logging.basicConfig(
@@ -58,9 +96,15 @@ class AnalizadorMovil:
             ]
         )
         self.logger = logging.getLogger(__name__)
+        
+        threading.Thread(target=self._bucle_escritura, daemon=True).start()
 
     def _inicializar_bd(self):
         """Inicializa la base de datos SQLite"""
+        # WAL: las escrituras no bloquean a los lectores y el commit no exige fsync
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
         cursor = self.conn.cursor()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS detecciones_imsi (
@@ -99,38 +143,97 @@ class AnalizadorMovil:
         ''')
         self.conn.commit()
 
+    def encolar_deteccion(self, fila: Tuple):
+        """Encola una fila de detecciones_imsi para el hilo escritor"""
+        self._cola_escritura.put((self.SQL_DETECCION, fila))
+
+    def _bucle_escritura(self):
+        """Hilo escritor que vacía la cola en lotes de hasta LOTE_MAXIMO filas"""
+        while True:
+            lote = [self._cola_escritura.get()]
+            try:
+                while len(lote) < self.LOTE_MAXIMO:
+                    lote.append(self._cola_escritura.get_nowait())
+            except queue.Empty:
+                pass
+            # Las marcas de volcar_bd (sentencia None) se liberan tras confirmar el lote que las contiene
+            marcas = [fila for sentencia, fila in lote if sentencia is None]
+            try:
+                self._escribir_lote(lote)
+            except Exception as e:
+                self.logger.error(f"Error escribiendo eventos en la base de datos: {e}")
+                # Si también falla el rollback el hilo escritor debe seguir vivo
+                try:
+                    self.conn.rollback()
+                except Exception as e:
+                    self.logger.error(f"Error deshaciendo el lote fallido: {e}")
+            finally:
+                for marca in marcas:
+                    marca.set()
+
+    def _escribir_lote(self, lote: List[Tuple]):
+        """Escribe un lote en una sola transacción, agrupando las filas por sentencia"""
+        filas_por_sentencia = defaultdict(list)
+        for sentencia, fila in lote:
+            if sentencia is not None:
+                filas_por_sentencia[sentencia].append(fila)
+        for sentencia, filas in filas_por_sentencia.items():
+            self._cursor_escritura.executemany(sentencia, filas)
+        self.conn.commit()
+
+    def conexion_lectura(self) -> sqlite3.Connection:
+        """Abre una conexión de solo lectura; con WAL no bloquea al escritor"""
+        uri = Path(self.archivo_bd).resolve().as_uri() + '?mode=ro'
+        return sqlite3.connect(uri, uri=True)
+
+    def volcar_bd(self):
+        """
+        Espera a que el hilo escritor haya guardado todo lo encolado hasta ahora; lo que
+        llegue después no retrasa la espera, a diferencia de Queue.join()
+        """
+        marca = threading.Event()
+        self._cola_escritura.put((None, marca))
+        marca.wait()
+
     def analizar_comportamiento_sospechoso(self, evento: EventoIMSI):
         """Detecta comportamientos anómalos en tiempo real"""
         with self.lock:
-            ahora = datetime.now()
+            ahora = evento.timestamp
             
             # Detectar reasignaciones rápidas de TMSI
-            self.reasignaciones_rapidas[evento.imsi].append(ahora)
+            heapq.heappush(self._eventos_ventana, (ahora + self.VENTANA_REASIGNACIONES_NS, evento.imsi))
+            self.reasignaciones_rapidas[evento.imsi] += 1
             # Mantener solo eventos de los últimos 5 minutos
-            while (self.reasignaciones_rapidas[evento.imsi] and 
-                   ahora - self.reasignaciones_rapidas[evento.imsi][0] > timedelta(minutes=5)):
-                self.reasignaciones_rapidas[evento.imsi].popleft()
+            while self._eventos_ventana and self._eventos_ventana[0][0] < ahora:
+                _, imsi = heapq.heappop(self._eventos_ventana)
+                self.reasignaciones_rapidas[imsi] -= 1
+                if not self.reasignaciones_rapidas[imsi]:
+                    del self.reasignaciones_rapidas[imsi]
             
-            if len(self.reasignaciones_rapidas[evento.imsi]) > 10:
+            # Los umbrales se comprueban antes de construir ningún texto
+            reasignaciones = self.reasignaciones_rapidas[evento.imsi]
+            if reasignaciones > 10:
                 self._generar_alerta(
                     "REASIGNACION_TMSI_RAPIDA",
                     "ALTA",
-                    f"IMSI {evento.imsi} con {len(self.reasignaciones_rapidas[evento.imsi])} reasignaciones en 5 min",
-                    evento.imsi
+                    evento.imsi,
+                    "IMSI %s con %d reasignaciones en 5 min", evento.imsi, reasignaciones
                 )
 
             # Detectar IMSI hopping entre celdas
-            self.imsi_hopping[evento.imsi].add((evento.lac, evento.cell_id))
-            if len(self.imsi_hopping[evento.imsi]) > 5:
+            celdas = self.imsi_hopping[evento.imsi]
+            celdas.add((evento.lac, evento.cell_id))
+            if len(celdas) > 5:
                 self._generar_alerta(
                     "IMSI_HOPPING",
                     "MEDIA",
-                    f"IMSI {evento.imsi} detectado en {len(self.imsi_hopping[evento.imsi])} celdas diferentes",
-                    evento.imsi
+                    evento.imsi,
+                    "IMSI %s detectado en %d celdas diferentes", evento.imsi, len(celdas)
                 )
 
-    def _generar_alerta(self, tipo: str, severidad: str, descripcion: str, imsi: str):
-        """Registra una alerta en el sistema"""
+    def _generar_alerta(self, tipo: str, severidad: str, imsi: str, formato: str, *args):
+        """Registra una alerta en el sistema; la descripción se compone solo aquí"""
+        descripcion = formato % args
         alerta = {
             'timestamp': datetime.now(),
             'tipo': tipo,
@@ -139,18 +242,14 @@ class AnalizadorMovil:
             'imsi': imsi
         }
         self.alertas.append(alerta)
+        self._cola_escritura.put((self.SQL_ALERTA, (tipo, severidad, descripcion, imsi)))
         
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT INTO alertas (tipo_alerta, severidad, descripcion, imsi_involucrado)
-            VALUES (?, ?, ?, ?)
-        ''', (tipo, severidad, descripcion, imsi))
-        self.conn.commit()
-        
-        self.logger.warning(f"ALERTA {severidad}: {tipo} - {descripcion}")
+        self.logger.warning("ALERTA %s: %s - %s", severidad, tipo, descripcion)
 
     def generar_reporte_avanzado(self):
         """Genera reportes detallados de análisis"""
+        # Que el reporte incluya también los eventos aún en cola
+        self.volcar_bd()
         reporte = {
             'resumen': self._generar_resumen(),
             'patrones_sospechosos': self._analizar_patrones(),
@@ -166,14 +265,15 @@ class AnalizadorMovil:
 
     def _generar_resumen(self) -> Dict:
         """Genera resumen ejecutivo"""
-        cursor = self.conn.cursor()
-        
-        cursor.execute('''
-            SELECT COUNT(DISTINCT imsi), COUNT(*), COUNT(DISTINCT mcc)
-            FROM detecciones_imsi 
-            WHERE timestamp > datetime('now', '-1 day')
-        ''')
-        total_imsi, total_eventos, total_paises = cursor.fetchone()
+        with closing(self.conexion_lectura()) as conn:
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT COUNT(DISTINCT imsi), COUNT(*), COUNT(DISTINCT mcc)
+                FROM detecciones_imsi 
+                WHERE timestamp > datetime('now', '-1 day')
+            ''')
+            total_imsi, total_eventos, total_paises = cursor.fetchone()
         
         return {
             'total_imsi_unicos': total_imsi,
@@ -186,12 +286,13 @@ class AnalizadorMovil:
 class SistemaGeolocalizacion:
     def __init__(self, analizador: AnalizadorMovil):
         self.analizador = analizador
-        self.historial_ubicaciones = defaultdict(list)
+        # Máximo 100 ubicaciones por IMSI: la deque descarta la más antigua
+        self.historial_ubicaciones = defaultdict(lambda: deque(maxlen=100))
         
     def agregar_ubicacion(self, imsi: str, mcc: str, mnc: str, lac: str, cell_id: str):
         """Registra la ubicación de un IMSI"""
         ubicacion = {
-            'timestamp': datetime.now(),
+            'timestamp': time.time(),
             'mcc': mcc,
             'mnc': mnc,
             'lac': lac,
@@ -201,28 +302,26 @@ class SistemaGeolocalizacion:
         }
         
         self.historial_ubicaciones[imsi].append(ubicacion)
-        # Mantener máximo 100 ubicaciones por IMSI
-        if len(self.historial_ubicaciones[imsi]) > 100:
-            self.historial_ubicaciones[imsi].pop(0)
 
     def _obtener_pais(self, mcc: str) -> str:
         """Obtiene el país basado en MCC"""
-        return self.analizador.codigos_mcc_mnc.get(mcc, {}).get('c', ['Desconocido'])[0]
+        return self.analizador.paises.get(mcc, 'Desconocido')
 
     def _obtener_operador(self, mcc: str, mnc: str) -> str:
         """Obtiene el operador basado en MCC y MNC"""
-        return self.analizador.codigos_mcc_mnc.get(mcc, {}).get('MNC', {}).get(mnc, ['Desconocido'])[1]
+        return self.analizador.operadores.get((mcc, mnc), OPERADOR_DESCONOCIDO)[2]
 
     def generar_mapa_calor(self):
         """Genera datos para mapa de calor de detecciones"""
         ubicaciones = []
         for imsi, historial in self.historial_ubicaciones.items():
-            for ubicacion in historial[-10:]:  # Últimas 10 ubicaciones
+            # Últimas 10 ubicaciones (una deque no admite slicing)
+            for ubicacion in islice(historial, max(len(historial) - 10, 0), None):
                 ubicaciones.append({
                     'imsi': imsi,
                     'pais': ubicacion['pais'],
                     'operador': ubicacion['operador'],
-                    'timestamp': ubicacion['timestamp']
+                    'timestamp': datetime.fromtimestamp(ubicacion['timestamp'])
                 })
         return ubicaciones
 
@@ -254,16 +353,17 @@ class InterfazWeb(threading.Thread):
             @app.route('/api/imsi-activos')
             def api_imsi_activos():
                 # IMSI activos en los últimos 15 minutos
-                cursor = self.analizador.conn.cursor()
-                cursor.execute('''
-                    SELECT DISTINCT imsi, MAX(timestamp) as ultima_deteccion
-                    FROM detecciones_imsi 
-                    WHERE timestamp > datetime('now', '-15 minutes')
-                    GROUP BY imsi
-                    ORDER BY ultima_deteccion DESC
-                ''')
-                return jsonify([{'imsi': row[0], 'ultima_deteccion': row[1]} 
-                              for row in cursor.fetchall()])
+                with closing(self.analizador.conexion_lectura()) as conn:
+                    cursor = conn.cursor()
+                    cursor.execute('''
+                        SELECT DISTINCT imsi, MAX(timestamp) as ultima_deteccion
+                        FROM detecciones_imsi 
+                        WHERE timestamp > datetime('now', '-15 minutes')
+                        GROUP BY imsi
+                        ORDER BY ultima_deteccion DESC
+                    ''')
+                    return jsonify([{'imsi': row[0], 'ultima_deteccion': row[1]} 
+                                  for row in cursor.fetchall()])
             
             app.run(host='0.0.0.0', port=self.puerto, debug=False)
         except ImportError:
@@ -320,7 +420,7 @@ class AnalizadorMovilAvanzado:
             
             if imsi_info:
                 evento = EventoIMSI(
-                    timestamp=datetime.now(),
+                    timestamp=time.monotonic_ns(),
                     imsi=imsi_info['imsi'],
                     tmsi=imsi_info['tmsi'],
                     tipo_evento='DETECCION',
@@ -344,19 +444,13 @@ class AnalizadorMovilAvanzado:
             self.analizador.logger.error(f"Error procesando paquete: {e}")
 
     def _guardar_evento_bd(self, evento: EventoIMSI):
-        """Guarda evento en base de datos"""
-        cursor = self.analizador.conn.cursor()
-        cursor.execute('''
-            INSERT INTO detecciones_imsi 
-            (imsi, tmsi, mcc, mnc, lac, cell_id, tipo_evento, pais, operador)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
+        """Encola el evento para el próximo volcado a la base de datos"""
+        self.analizador.encolar_deteccion((
             evento.imsi, evento.tmsi, evento.mcc, evento.mnc, 
             evento.lac, evento.cell_id, evento.tipo_evento,
             self.geolocalizacion._obtener_pais(evento.mcc),
             self.geolocalizacion._obtener_operador(evento.mcc, evento.mnc)
         ))
-        self.analizador.conn.commit()
 
     def agregar_filtro_personalizado(self, filtro):
         """Permite agregar filtros personalizados para detección"""
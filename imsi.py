@@ -1,109 +1,175 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import sys
 import json
 import time
+import atexit
+import threading
+import errno
+import ctypes
+import socket
+import struct
+import mmap
+import select
+import marshal
 from optparse import OptionParser
-from scapy.all import sniff
-
-# Variables globales
-imsis_detectados = []
-tmsis_asociados = {}
-contador_imsi = 0
-mcc_actual = ""
-mnc_actual = ""
-lac_actual = ""
-celda_actual = ""
-pais_actual = ""
-marca_actual = ""
-operador_actual = ""
-imsi_a_seguir = ""
-longitud_imsi_seguir = 0
-mostrar_todos_tmsi = False
-
-# Cargar códigos MCC-MNC al inicio
-with open('mcc-mnc/mcc_codes.json', 'r') as archivo:
-    codigos_mcc_mnc = json.load(archivo)
+from functools import lru_cache
+from operator import itemgetter
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from numba import njit
+    NUMBA_DISPONIBLE = True
+except ImportError:
+    NUMBA_DISPONIBLE = False
+
+    def njit(*args, **kwargs):
+        """Sustituto sin efecto cuando numba no está instalado"""
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda funcion: funcion
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class Contexto:
+    """Estado de la captura: identidades vistas, celda actual y opciones de seguimiento"""
+    __slots__ = ('imsis_detectados', 'tmsis_asociados',
+                 'mcc', 'mnc', 'lac', 'celda', 'pais', 'marca', 'operador', 'ultima_celda',
+                 'imsi_a_seguir', 'mostrar_todos_tmsi')
+    
+    def __init__(self, imsi_a_seguir=b"", mostrar_todos_tmsi=False):
+        # IMSI -> el mismo IMSI: la clave guardada es el objeto canónico que se reutiliza
+        # como valor en tmsis_asociados, así cada abonado ocupa un único objeto bytes
+        self.imsis_detectados = {}
+        self.tmsis_asociados = {}
+        self.mcc = ""
+        self.mnc = ""
+        self.lac = ""
+        self.celda = ""
+        self.pais = ""
+        self.marca = ""
+        self.operador = ""
+        # Bytes 0x3d-0x43 del último mensaje tipo 3 decodificado
+        self.ultima_celda = b""
+        self.imsi_a_seguir = imsi_a_seguir
+        self.mostrar_todos_tmsi = mostrar_todos_tmsi
+
+RUTA_CODIGOS = 'mcc-mnc/mcc_codes.json'
+# Tablas planas ya construidas, se regeneran cuando el JSON es más reciente.
+# marshal solo reconstruye tipos básicos y no ejecuta código al cargar, a diferencia de pickle
+RUTA_CACHE_CODIGOS = 'mcc-mnc/mcc_codes.marshal'
+
+def cargar_tablas_operadores(ruta_json=RUTA_CODIGOS, ruta_cache=RUTA_CACHE_CODIGOS):
+    """
+    Devuelve (paises, operadores): MCC -> país y (MCC, MNC) -> (país, marca, operador).
+    Se leen de la caché marshal si está al día; si no, se construyen del JSON y se guarda la caché
+    """
+    try:
+        if os.path.getmtime(ruta_cache) >= os.path.getmtime(ruta_json):
+            with open(ruta_cache, 'rb') as archivo:
+                paises, operadores = marshal.load(archivo)
+            if isinstance(paises, dict) and isinstance(operadores, dict):
+                return paises, operadores
+    except (OSError, EOFError, ValueError, TypeError):
+        # Caché ausente, corrupta o de otra versión de Python: se reconstruye del JSON
+        pass
+    
+    with open(ruta_json, 'rb') as archivo:
+        contenido = archivo.read()
+    codigos_mcc_mnc = orjson.loads(contenido) if orjson is not None else json.loads(contenido)
+    
+    paises = {}
+    operadores = {}
+    for mcc, datos_mcc in codigos_mcc_mnc.items():
+        paises[mcc] = datos_mcc['c'][0]
+        for mnc, (marca, operador) in datos_mcc['MNC'].items():
+            operadores[(mcc, mnc)] = (datos_mcc['c'][0], marca, operador)
+    
+    # Escritura atómica; si el directorio no admite escritura se sigue sin caché
+    try:
+        temporal = f"{ruta_cache}.{os.getpid()}.tmp"
+        with open(temporal, 'wb') as archivo:
+            marshal.dump((paises, operadores), archivo)
+        os.replace(temporal, ruta_cache)
+    except OSError:
+        pass
+    
+    return paises, operadores
+
+# Tablas planas para resolver el operador con una sola búsqueda por paquete
+PAISES, OPERADORES = cargar_tablas_operadores()
+
+# Tabla de intercambio de nibbles: los dígitos del IMSI van en BCD con el nibble bajo primero
+# bytes.translate + hex() hacen el intercambio y la conversión en C (~0.1 µs por IMSI); un núcleo
+# numba sobre uint8 tarda más solo en la llamada y la conversión con numpy (~1.2 µs), así que no se usa aquí
+INTERCAMBIO_NIBBLES = bytes(((b & 0x0f) << 4) | (b >> 4) for b in range(256))
+
+# Los mismos abonados aparecen una y otra vez: cada IMSI/TMSI se formatea una sola vez
+@lru_cache(maxsize=4096)
 def formatear_tmsi(tmsi):
     """Convierte un TMSI a formato hexadecimal legible"""
     if not tmsi:
         return ""
-    
-    tmsi_hex = "0x"
-    for byte in tmsi:
-        hex_byte = hex(ord(byte))
-        if len(hex_byte) == 4:
-            tmsi_hex += hex_byte[2] + hex_byte[3]
-        else:
-            tmsi_hex += "0" + hex_byte[2]
-    return tmsi_hex
+    return "0x" + tmsi.hex()
 
-def formatear_imsi(imsi, paquete_original=""):
+@lru_cache(maxsize=4096)
+def formatear_imsi(imsi):
     """Formatea y decodifica un IMSI con información del operador"""
     if not imsi:
         return ""
     
-    imsi_formateado = ''
-    for byte in imsi:
-        hex_byte = hex(ord(byte))
-        if len(hex_byte) == 4:
-            imsi_formateado += hex_byte[3] + hex_byte[2]
-        else:
-            imsi_formateado += hex_byte[2] + "0"
+    imsi_formateado = imsi.translate(INTERCAMBIO_NIBBLES).hex()
     
     mcc = imsi_formateado[1:4]
     mnc = imsi_formateado[4:6]
-    pais = ""
-    marca = ""
-    operador = ""
-    
-    if mcc in codigos_mcc_mnc:
-        if mnc in codigos_mcc_mnc[mcc]['MNC']:
-            pais = codigos_mcc_mnc[mcc]['c'][0]
-            marca = codigos_mcc_mnc[mcc]['MNC'][mnc][0]
-            operador = codigos_mcc_mnc[mcc]['MNC'][mnc][1]
-            imsi_formateado = f"{mcc} {mnc} {imsi_formateado[6:]}"
-        elif mnc + imsi_formateado[6:7] in codigos_mcc_mnc[mcc]['MNC']:
+    info = OPERADORES.get((mcc, mnc))
+    if info is None:
+        info = OPERADORES.get((mcc, mnc + imsi_formateado[6:7]))
+        if info is not None:
             mnc += imsi_formateado[6:7]
-            pais = codigos_mcc_mnc[mcc]['c'][0]
-            marca = codigos_mcc_mnc[mcc]['MNC'][mnc][0]
-            operador = codigos_mcc_mnc[mcc]['MNC'][mnc][1]
-            imsi_formateado = f"{mcc} {mnc} {imsi_formateado[7:]}"
-        else:
-            pais = codigos_mcc_mnc[mcc]['c'][0]
-            marca = f"MNC {mnc} Desconocido"
-            operador = f"MNC {mnc} Desconocido"
-            imsi_formateado = f"{mcc} {mnc} {imsi_formateado[6:]}"
+    
+    if info is not None:
+        pais, marca, operador = info
+        imsi_formateado = f"{mcc} {mnc} {imsi_formateado[len(mnc) + 4:]}"
+    elif mcc in PAISES:
+        pais = PAISES[mcc]
+        marca = f"MNC {mnc} Desconocido"
+        operador = f"MNC {mnc} Desconocido"
+        imsi_formateado = f"{mcc} {mnc} {imsi_formateado[6:]}"
     else:
         pais = f"MCC {mcc} Desconocido"
         marca = f"MNC {mnc} Desconocido"
         operador = f"MNC {mnc} Desconocido"
     
-    try:
-        linea_formateada = f"{imsi_formateado:17s} ; {pais:12s} ; {marca:10s} ; {operador:21s}"
-    except Exception as e:
-        print(f"Error al formatear IMSI: {e}", paquete_original, imsi_formateado, pais, marca, operador)
-        linea_formateada = ""
-    
-    return linea_formateada
+    return f"{imsi_formateado:17s} ; {pais:12s} ; {marca:10s} ; {operador:21s}"
 
-def mostrar_imsi(imsi1="", imsi2="", tmsi1="", tmsi2="", paquete_original=""):
+def mostrar_imsi(contexto, imsi1=b"", imsi2=b"", tmsi1=b"", tmsi2=b""):
     """Procesa y muestra información de IMSI/TMSI detectados"""
-    global imsis_detectados, tmsis_asociados, contador_imsi
-    global mcc_actual, mnc_actual, lac_actual, celda_actual
+    imsis_detectados = contexto.imsis_detectados
+    tmsis_asociados = contexto.tmsis_asociados
+    imsi_a_seguir = contexto.imsi_a_seguir
     
     debe_imprimir = False
     numero_imsi = ''
     
     # Procesar IMSI 1
-    if imsi1 and (not imsi_a_seguir or imsi1[:longitud_imsi_seguir] == imsi_a_seguir):
-        if imsi1 not in imsis_detectados:
+    if imsi1 and (not imsi_a_seguir or imsi1.startswith(imsi_a_seguir)):
+        canonico = imsis_detectados.get(imsi1)
+        if canonico is None:
             debe_imprimir = True
-            imsis_detectados.append(imsi1)
-            contador_imsi += 1
-            numero_imsi = contador_imsi
+            imsis_detectados[imsi1] = imsi1
+            numero_imsi = len(imsis_detectados)
+        else:
+            imsi1 = canonico
         
         # Asociar TMSIs con IMSI
         for tmsi in [tmsi1, tmsi2]:
@@ -112,12 +178,14 @@ def mostrar_imsi(imsi1="", imsi2="", tmsi1="", tmsi2="", paquete_original=""):
                 tmsis_asociados[tmsi] = imsi1
     
     # Procesar IMSI 2
-    if imsi2 and (not imsi_a_seguir or imsi2[:longitud_imsi_seguir] == imsi_a_seguir):
-        if imsi2 not in imsis_detectados:
+    if imsi2 and (not imsi_a_seguir or imsi2.startswith(imsi_a_seguir)):
+        canonico = imsis_detectados.get(imsi2)
+        if canonico is None:
             debe_imprimir = True
-            imsis_detectados.append(imsi2)
-            contador_imsi += 1
-            numero_imsi = contador_imsi
+            imsis_detectados[imsi2] = imsi2
+            numero_imsi = len(imsis_detectados)
+        else:
+            imsi2 = canonico
         
         for tmsi in [tmsi1, tmsi2]:
             if tmsi and (tmsi not in tmsis_asociados or tmsis_asociados[tmsi] != imsi2):
@@ -136,107 +204,442 @@ def mostrar_imsi(imsi1="", imsi2="", tmsi1="", tmsi2="", paquete_original=""):
     if debe_imprimir:
         for imsi in [imsi1, imsi2]:
             if imsi:
-                linea = f"{str(numero_imsi):7s} ; {formatear_tmsi(tmsi1):10s} ; {formatear_tmsi(tmsi2):10s} ; {formatear_imsi(imsi, paquete_original)} ; {mcc_actual:4s} ; {mnc_actual:5s} ; {lac_actual:6s} ; {celda_actual:6s}"
-                print(linea)
-                sys.stdout.flush()
+                linea = f"{str(numero_imsi):7s} ; {formatear_tmsi(tmsi1):10s} ; {formatear_tmsi(tmsi2):10s} ; {formatear_imsi(imsi)} ; {contexto.mcc:4s} ; {contexto.mnc:5s} ; {contexto.lac:6s} ; {contexto.celda:6s}"
+                escribir_linea(linea)
     
     # Mostrar TMSIs sin IMSI asociado (si está habilitado)
-    if not imsi1 and not imsi2 and mostrar_todos_tmsi:
+    if not imsi1 and not imsi2 and contexto.mostrar_todos_tmsi:
         for tmsi in [tmsi1, tmsi2]:
             if tmsi and tmsi not in tmsis_asociados:
                 tmsis_asociados[tmsi] = ""
 
-def decodificar_info_celda(paquete):
-    """Decodifica información de la celda (MCC, MNC, LAC, Cell ID)"""
-    global mcc_actual, mnc_actual, lac_actual, celda_actual
-    global pais_actual, marca_actual, operador_actual
+# Información del sistema tipo 3 desde 0x3d: Cell ID, MCC (2 bytes), MNC y LAC
+FORMATO_CELDA = struct.Struct('>HBBBH')
+CAMPOS_CELDA = FORMATO_CELDA.unpack
+
+def decodificar_info_celda(contexto, datos):
+    """
+    Decodifica información de la celda (MCC, MNC, LAC, Cell ID) de un mensaje de
+    información del sistema tipo 3, ya identificado por analizar_gsmtap
+    """
+    # Parado en una celda, el mensaje se repite sin cambios: el contexto ya tiene sus valores
+    clave = bytes(datos[0x3d:0x3d + FORMATO_CELDA.size])
+    if clave == contexto.ultima_celda:
+        return
+    contexto.ultima_celda = clave
     
-    datos = str(paquete)
+    celda, mcc12, mcc3, mnc, lac = CAMPOS_CELDA(clave)
     
-    # Verificar si es mensaje de información del sistema tipo 3
-    if ord(datos[0x36]) == 0x01 and ord(datos[0x3c]) == 0x1b:
-        # Decodificar MCC
-        byte_mcc = hex(ord(datos[0x3f]))
-        mcc_actual = byte_mcc[2] + '0' if len(byte_mcc) < 4 else byte_mcc[3] + byte_mcc[2]
-        mcc_actual += str(ord(datos[0x40]) & 0x0f)
-        
-        # Decodificar MNC
-        byte_mnc = hex(ord(datos[0x41]))
-        mnc_actual = byte_mnc[2] + '0' if len(byte_mnc) < 4 else byte_mnc[3] + byte_mnc[2]
-        
-        # Decodificar LAC y Cell ID
-        lac_actual = str(ord(datos[0x42]) * 256 + ord(datos[0x43]))
-        celda_actual = str(ord(datos[0x3d]) * 256 + ord(datos[0x3e]))
+    # MCC y MNC en dígitos BCD, nibble bajo primero
+    mcc_actual = f"{mcc12 & 0x0f:x}{mcc12 >> 4:x}{mcc3 & 0x0f}"
+    mnc_actual = f"{mnc & 0x0f:x}{mnc >> 4:x}"
+    contexto.mcc = mcc_actual
+    contexto.mnc = mnc_actual
+    contexto.lac = str(lac)
+    contexto.celda = str(celda)
+    
+    # Buscar información del operador
+    info = OPERADORES.get((mcc_actual, mnc_actual))
+    if info is not None:
+        contexto.pais, contexto.marca, contexto.operador = info
+    else:
+        contexto.pais = PAISES.get(mcc_actual, f"MCC {mcc_actual} Desconocido")
+        contexto.marca = f"MNC {mnc_actual} Desconocido"
+        contexto.operador = f"MNC {mnc_actual} Desconocido"
+
+# Formatos de paquete reconocidos por analizar_gsmtap, usados como índice en DESPACHO
+SIN_COINCIDENCIA = 0
+INFO_SISTEMA_3 = 1
+IDENTIDAD_IMSI_IMSI = 2
+IDENTIDAD_IMSI_TMSI = 3
+IDENTIDAD_IMSI = 4
+IDENTIDAD_TMSI_IMSI = 5
+IDENTIDAD_TMSI_TMSI = 6
+IDENTIDAD_TMSI = 7
+REASIGNACION_TMSI = 8
+
+@njit(cache=True, nogil=True)
+def analizar_gsmtap(buf):
+    """Identifica el formato de un paquete GSMTAP (bytes o buffer uint8), una de las constantes anteriores"""
+    if len(buf) < 0x4a:
+        return SIN_COINCIDENCIA
+    
+    # Canal BCCH: solo interesa la información del sistema tipo 3
+    if buf[0x36] == 0x01:
+        if buf[0x3c] == 0x1b:
+            return INFO_SISTEMA_3
+        return SIN_COINCIDENCIA
+    
+    # Mensaje de identidad móvil
+    if buf[0x3c] == 0x21:
+        # IMSI en solicitud de identidad
+        if buf[0x3e] == 0x08 and (buf[0x3f] & 0x1) == 0x1:
+            # Segundo IMSI posible
+            if buf[0x3a] == 0x59 and buf[0x48] == 0x08 and (buf[0x49] & 0x1) == 0x1:
+                return IDENTIDAD_IMSI_IMSI
+            # TMSI en lugar de segundo IMSI
+            elif buf[0x3a] == 0x59 and buf[0x48] == 0x08 and (buf[0x49] & 0x1) == 0x1:
+                return IDENTIDAD_IMSI_TMSI
+            return IDENTIDAD_IMSI
         
-        # Buscar información del operador
-        if mcc_actual in codigos_mcc_mnc:
-            if mnc_actual in codigos_mcc_mnc[mcc_actual]['MNC']:
-                pais_actual = codigos_mcc_mnc[mcc_actual]['c'][0]
-                marca_actual = codigos_mcc_mnc[mcc_actual]['MNC'][mnc_actual][0]
-                operador_actual = codigos_mcc_mnc[mcc_actual]['MNC'][mnc_actual][1]
-            else:
-                pais_actual = codigos_mcc_mnc[mcc_actual]['c'][0]
-                marca_actual = f"MNC {mnc_actual} Desconocido"
-                operador_actual = f"MNC {mnc_actual} Desconocido"
-        else:
-            pais_actual = f"MCC {mcc_actual} Desconocido"
-            marca_actual = f"MNC {mnc_actual} Desconocido"
-            operador_actual = f"MNC {mnc_actual} Desconocido"
+        # IMSI con TMSI previo
+        elif buf[0x45] == 0x08 and (buf[0x46] & 0x1) == 0x1:
+            return IDENTIDAD_TMSI_IMSI
         
-        return True
+        # Intercambio de TMSI
+        elif buf[0x3e] == 0x05 and (buf[0x3f] & 0x07) == 4:
+            if buf[0x45] == 0x05 and (buf[0x46] & 0x07) == 4:
+                return IDENTIDAD_TMSI_TMSI
+            return IDENTIDAD_TMSI
+    
+    # Mensaje de reasignación de TMSI
+    elif buf[0x3c] == 0x22:
+        if buf[0x47] == 0x08 and (buf[0x48] & 0x1) == 0x1:
+            return REASIGNACION_TMSI
     
-    return False
+    return SIN_COINCIDENCIA
+
+def manejador_identidad(imsi1, imsi2, tmsi1, tmsi2):
+    """
+    Construye el manejador de un formato de identidad: los desplazamientos (-1 = ausente)
+    se fijan aquí una vez, así el manejador corta los cuatro campos con una sola llamada
+    """
+    # Un campo ausente es el corte vacío, que devuelve b"" sin reservar memoria
+    cortes = itemgetter(*(slice(desplazamiento, desplazamiento + longitud) if desplazamiento >= 0 else slice(0, 0)
+                          for desplazamiento, longitud in ((imsi1, 8), (imsi2, 8), (tmsi1, 4), (tmsi2, 4))))
+    
+    def manejador(contexto, datos):
+        # datos puede ser una vista del anillo de captura: se copia una vez y cada campo es un único corte
+        datos = bytes(datos)
+        mostrar_imsi(contexto, *cortes(datos))
+    return manejador
+
+# Manejador de cada formato devuelto por analizar_gsmtap, indexado por su constante
+DESPACHO = [None] * (REASIGNACION_TMSI + 1)
+DESPACHO[INFO_SISTEMA_3] = decodificar_info_celda
+DESPACHO[IDENTIDAD_IMSI_IMSI] = manejador_identidad(0x3f, 0x49, -1, -1)
+DESPACHO[IDENTIDAD_IMSI_TMSI] = manejador_identidad(0x3f, -1, 0x4a, -1)
+DESPACHO[IDENTIDAD_IMSI] = manejador_identidad(0x3f, -1, -1, -1)
+DESPACHO[IDENTIDAD_TMSI_IMSI] = manejador_identidad(-1, 0x46, 0x40, -1)
+DESPACHO[IDENTIDAD_TMSI_TMSI] = manejador_identidad(-1, -1, 0x40, 0x47)
+DESPACHO[IDENTIDAD_TMSI] = manejador_identidad(-1, -1, 0x40, -1)
+DESPACHO[REASIGNACION_TMSI] = manejador_identidad(-1, 0x48, 0x3e, 0x42)
 
-def buscar_imsi(paquete):
+def buscar_imsi(contexto, datos):
     """Función principal que analiza paquetes en busca de IMSI/TMSI"""
-    decodificar_info_celda(paquete)
-    datos = str(paquete)
+    if NUMBA_DISPONIBLE:
+        manejador = DESPACHO[analizar_gsmtap(np.frombuffer(datos, dtype=np.uint8))]
+    else:
+        manejador = DESPACHO[analizar_gsmtap(datos)]
+    if manejador is not None:
+        manejador(contexto, datos)
+
+if NUMBA_DISPONIBLE:
+    # Compilar (o cargar de la caché) el analizador ahora y no con el primer paquete
+    analizar_gsmtap(np.zeros(0x51, dtype=np.uint8))
+
+# Líneas pendientes de escribir en la salida estándar, volcadas con os.write por lotes
+salida_pendiente = bytearray()
+cerrojo_salida = threading.Lock()
+LIMITE_SALIDA = 4096
+
+def volcar_salida():
+    """Escribe en el descriptor 1 todo lo pendiente"""
+    with cerrojo_salida:
+        vista = memoryview(salida_pendiente)
+        while vista:
+            vista = vista[os.write(1, vista):]
+        vista.release()
+        salida_pendiente.clear()
+
+def escribir_linea(linea):
+    """Añade una línea a la salida; se vuelca al superar LIMITE_SALIDA o con el volcado periódico"""
+    with cerrojo_salida:
+        salida_pendiente.extend(linea.encode() + b"\n")
+        lleno = len(salida_pendiente) > LIMITE_SALIDA
+    if lleno:
+        volcar_salida()
+
+def vaciar_salida_periodicamente(intervalo=0.2):
+    """Vacía la salida con retardo acotado en lugar de hacer una escritura por línea"""
+    while True:
+        time.sleep(intervalo)
+        volcar_salida()
+
+ETH_P_ALL = 0x0003
+SO_ATTACH_FILTER = 26
+MSG_WAITFORONE = 0x10000
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+# Anillo de recepción PACKET_MMAP: 64 bloques de 64 KiB, cada bloque se entrega lleno o a los 100 ms
+TAMANO_BLOQUE_ANILLO = 1 << 16
+NUMERO_BLOQUES_ANILLO = 64
+TAMANO_TRAMA_ANILLO = 2048
+ESPERA_BLOQUE_ANILLO_MS = 100
+# struct tpacket3_hdr ocupa 48 bytes, le sigue struct sockaddr_ll con sll_pkttype en el desplazamiento 10
+PKTTYPE_TPACKET3 = 48 + 10
+
+# recvmmsg: hasta 64 tramas por llamada al sistema, 2048 bytes sobran para una trama GSMTAP
+TAMANO_LOTE = 64
+TAMANO_TRAMA = 2048
+# struct sockaddr_ll ocupa 20 bytes, sll_pkttype está en el desplazamiento 10
+TAMANO_SOCKADDR_LL = 20
+DESPLAZAMIENTO_PKTTYPE = 10
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)), ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+def filtro_gsmtap(puerto):
+    """
+    Programa BPF clásico: "udp port <puerto>" sobre IPv4/Ethernet (salida de tcpdump -dd)
+    seguido de las mismas comprobaciones GSMTAP que buscar_imsi, para que el kernel
+    descarte todo lo que no sea información del sistema tipo 3 o un mensaje de identidad
+    """
+    return [
+        (0x28, 0, 0, 12),         # ldh [12]               ethertype
+        (0x15, 0, 19, 0x0800),    # jeq #0x800             IPv4
+        (0x30, 0, 0, 23),         # ldb [23]               protocolo
+        (0x15, 0, 17, 17),        # jeq #17                UDP
+        (0x28, 0, 0, 20),         # ldh [20]               flags + desplazamiento de fragmento
+        (0x45, 15, 0, 0x1fff),    # jset #0x1fff           descartar fragmentos
+        (0xb1, 0, 0, 14),         # ldxb 4*([14]&0xf)      longitud de la cabecera IP
+        (0x48, 0, 0, 14),         # ldh [x+14]             puerto origen
+        (0x15, 2, 0, puerto),     # jeq #puerto
+        (0x48, 0, 0, 16),         # ldh [x+16]             puerto destino
+        (0x15, 0, 10, puerto),    # jeq #puerto
+        (0x80, 0, 0, 0),          # ld #pktlen
+        (0x35, 0, 8, 0x4a),       # jge #0x4a              buscar_imsi lee hasta datos[0x49]
+        (0x30, 0, 0, 0x36),       # ldb [0x36]             subtipo GSMTAP (canal)
+        (0x15, 0, 2, 0x01),       # jeq #0x1               BCCH
+        (0x30, 0, 0, 0x3c),       # ldb [0x3c]             tipo de mensaje
+        (0x15, 3, 4, 0x1b),       # jeq #0x1b              información del sistema tipo 3
+        (0x30, 0, 0, 0x3c),       # ldb [0x3c]             tipo de mensaje
+        (0x15, 1, 0, 0x21),       # jeq #0x21              identidad móvil
+        (0x15, 0, 1, 0x22),       # jeq #0x22              reasignación de TMSI
+        (0x06, 0, 0, 0x40000),    # ret #262144            aceptar
+        (0x06, 0, 0, 0),          # ret #0                 descartar
+    ]
+
+def abrir_captura(interfaz, puerto):
+    """Abre un socket AF_PACKET con el filtro BPF ya aplicado por el kernel"""
+    # Con protocolo 0 no se recibe nada hasta bind(), así ningún paquete entra antes del filtro
+    sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+    programa = filtro_gsmtap(puerto)
+    instrucciones = ctypes.create_string_buffer(b"".join(struct.pack("HBBI", *i) for i in programa))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, struct.pack("HL", len(programa), ctypes.addressof(instrucciones)))
+    sock.bind((interfaz, ETH_P_ALL))
+    return sock
+
+def mapear_anillo_rx(sock):
+    """Configura un anillo TPACKET_V3 en el socket y lo proyecta en memoria"""
+    sock.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+    numero_tramas = TAMANO_BLOQUE_ANILLO * NUMERO_BLOQUES_ANILLO // TAMANO_TRAMA_ANILLO
+    # struct tpacket_req3
+    sock.setsockopt(SOL_PACKET, PACKET_RX_RING, struct.pack("IIIIIII", TAMANO_BLOQUE_ANILLO, NUMERO_BLOQUES_ANILLO,
+                    TAMANO_TRAMA_ANILLO, numero_tramas, ESPERA_BLOQUE_ANILLO_MS, 0, 0))
+    return mmap.mmap(sock.fileno(), TAMANO_BLOQUE_ANILLO * NUMERO_BLOQUES_ANILLO,
+                     mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+
+def leer_paquetes(sock, contexto):
+    """Entrega cada trama recibida a buscar_imsi: anillo PACKET_MMAP, si no recvmmsg, si no recvfrom"""
+    try:
+        anillo = mapear_anillo_rx(sock)
+    except OSError:
+        # Sin TPACKET_V3 (Linux < 3.2): lotes con recvmmsg
+        leer_paquetes_recvmmsg(sock, contexto)
+    else:
+        leer_paquetes_anillo(sock, anillo, contexto)
+
+def leer_paquetes_anillo(sock, anillo, contexto):
+    """
+    Recorre los bloques del anillo a medida que el kernel los llena: sin llamada al sistema
+    por paquete, y cada trama llega a buscar_imsi como una vista sin copia sobre el anillo
+    """
+    vista = memoryview(anillo)
+    sondeo = select.poll()
+    sondeo.register(sock, select.POLLIN | select.POLLERR)
+    bloque = 0
+    while True:
+        inicio = bloque * TAMANO_BLOQUE_ANILLO
+        # struct tpacket_block_desc: version, offset_to_priv y luego block_status, num_pkts, offset_to_first_pkt
+        estado, numero_paquetes, desplazamiento = struct.unpack_from("III", anillo, inicio + 8)
+        if not estado & TP_STATUS_USER:
+            sondeo.poll()
+            continue
+        
+        paquete = inicio + desplazamiento
+        for _ in range(numero_paquetes):
+            # struct tpacket3_hdr: tp_next_offset, tp_sec, tp_nsec, tp_snaplen ... tp_mac en 24
+            siguiente, _, _, longitud = struct.unpack_from("IIII", anillo, paquete)
+            mac, = struct.unpack_from("H", anillo, paquete + 24)
+            # En lo cada paquete se ve dos veces, al salir y al entrar
+            if anillo[paquete + PKTTYPE_TPACKET3] != socket.PACKET_OUTGOING:
+                buscar_imsi(contexto, vista[paquete + mac:paquete + mac + longitud])
+            paquete += siguiente
+        
+        # Devolver el bloque al kernel
+        struct.pack_into("I", anillo, inicio + 8, TP_STATUS_KERNEL)
+        bloque = (bloque + 1) % NUMERO_BLOQUES_ANILLO
+
+def leer_paquetes_recvmmsg(sock, contexto):
+    """Lotes de hasta TAMANO_LOTE tramas por llamada al sistema, si libc ofrece recvmmsg"""
+    libc = ctypes.CDLL(None, use_errno=True)
+    try:
+        recvmmsg = libc.recvmmsg
+    except AttributeError:
+        leer_paquetes_recvfrom(sock, contexto)
+        return
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
     
-    # Solo procesar si no es canal BCCH
-    if ord(datos[0x36]) != 0x1:
-        tmsi1, tmsi2, imsi1, imsi2 = "", "", "", ""
+    tramas = (ctypes.c_char * (TAMANO_TRAMA * TAMANO_LOTE))()
+    direcciones = (ctypes.c_char * (TAMANO_SOCKADDR_LL * TAMANO_LOTE))()
+    vectores = (iovec * TAMANO_LOTE)()
+    mensajes = (mmsghdr * TAMANO_LOTE)()
+    base_tramas = ctypes.addressof(tramas)
+    base_direcciones = ctypes.addressof(direcciones)
+    for i in range(TAMANO_LOTE):
+        vectores[i].iov_base = base_tramas + i * TAMANO_TRAMA
+        vectores[i].iov_len = TAMANO_TRAMA
+        mensajes[i].msg_hdr.msg_iov = ctypes.pointer(vectores[i])
+        mensajes[i].msg_hdr.msg_iovlen = 1
+        mensajes[i].msg_hdr.msg_name = base_direcciones + i * TAMANO_SOCKADDR_LL
+    
+    descriptor = sock.fileno()
+    while True:
+        for i in range(TAMANO_LOTE):
+            mensajes[i].msg_hdr.msg_namelen = TAMANO_SOCKADDR_LL
         
-        # Mensaje de identidad móvil
-        if ord(datos[0x3c]) == 0x21:
-            # IMSI en solicitud de identidad
-            if ord(datos[0x3e]) == 0x08 and (ord(datos[0x3f]) & 0x1) == 0x1:
-                imsi1 = datos[0x3f:][:8]
-                
-                # Segundo IMSI posible
-                if ord(datos[0x3a]) == 0x59 and ord(datos[0x48]) == 0x08 and (ord(datos[0x49]) & 0x1) == 0x1:
-                    imsi2 = datos[0x49:][:8]
-                # TMSI en lugar de segundo IMSI
-                elif ord(datos[0x3a]) == 0x59 and ord(datos[0x48]) == 0x08 and (ord(datos[0x49]) & 0x1) == 0x1:
-                    tmsi1 = datos[0x4a:][:4]
-                
-                mostrar_imsi(imsi1, imsi2, tmsi1, tmsi2, datos)
-            
-            # IMSI con TMSI previo
-            elif ord(datos[0x45]) == 0x08 and (ord(datos[0x46]) & 0x1) == 0x1:
-                tmsi1 = datos[0x40:][:4]
-                imsi2 = datos[0x46:][:8]
-                mostrar_imsi(imsi1, imsi2, tmsi1, tmsi2, datos)
-            
-            # Intercambio de TMSI
-            elif ord(datos[0x3e]) == 0x05 and (ord(datos[0x3f]) & 0x07) == 4:
-                tmsi1 = datos[0x40:][:4]
-                if ord(datos[0x45]) == 0x05 and (ord(datos[0x46]) & 0x07) == 4:
-                    tmsi2 = datos[0x47:][:4]
-                
-                mostrar_imsi(imsi1, imsi2, tmsi1, tmsi2, datos)
+        # MSG_WAITFORONE: bloquea hasta la primera trama y devuelve las que ya estén en cola
+        recibidos = recvmmsg(descriptor, mensajes, TAMANO_LOTE, MSG_WAITFORONE, None)
+        if recibidos < 0:
+            codigo = ctypes.get_errno()
+            if codigo == errno.EINTR:
+                continue
+            raise OSError(codigo, "recvmmsg: " + errno.errorcode.get(codigo, str(codigo)))
         
-        # Mensaje de reasignación de TMSI
-        elif ord(datos[0x3c]) == 0x22:
-            if ord(datos[0x47]) == 0x08 and (ord(datos[0x48]) & 0x1) == 0x1:
-                tmsi1 = datos[0x3e:][:4]
-                tmsi2 = datos[0x42:][:4]
-                imsi2 = datos[0x48:][:8]
-                mostrar_imsi(imsi1, imsi2, tmsi1, tmsi2, datos)
+        for i in range(recibidos):
+            # En lo cada paquete se ve dos veces, al salir y al entrar
+            if direcciones[i * TAMANO_SOCKADDR_LL + DESPLAZAMIENTO_PKTTYPE][0] != socket.PACKET_OUTGOING:
+                buscar_imsi(contexto, ctypes.string_at(base_tramas + i * TAMANO_TRAMA, mensajes[i].msg_len))
+
+def leer_paquetes_recvfrom(sock, contexto):
+    """Alternativa sin recvmmsg: una llamada al sistema por paquete"""
+    while True:
+        datos, direccion = sock.recvfrom(65535)
+        # En lo cada paquete se ve dos veces, al salir y al entrar
+        if direccion[2] != socket.PACKET_OUTGOING:
+            buscar_imsi(contexto, datos)
+
+# Magic de la cabecera pcap leída como '<I': orden de bytes del archivo
+ORDEN_PCAP = {0xa1b2c3d4: '<', 0xa1b23c4d: '<', 0xd4c3b2a1: '>', 0x4d3cb2a1: '>'}
+LINKTYPE_ETHERNET = 1
+# analizar_gsmtap no lee más allá de datos[0x49]
+COLUMNAS_PCAP = 0x4a
+
+def clasificar_tabla(tabla, longitudes, puerto):
+    """
+    Versión vectorizada de filtro_gsmtap + analizar_gsmtap sobre una tabla uint8
+    (una trama por fila): devuelve el formato de cada trama
+    """
+    b = tabla
+    
+    # Filtro del BPF: IPv4, UDP sin fragmentar, puerto GSMTAP y longitud mínima. Los puertos
+    # se leen en desplazamientos fijos, así que se exige además una cabecera IP sin opciones
+    # (IHL 5), la misma que suponen los desplazamientos GSMTAP en ambos casos
+    valida = (longitudes >= 0x4a) & (b[:, 12] == 0x08) & (b[:, 13] == 0x00) & (b[:, 23] == 17)
+    valida &= (b[:, 14] == 0x45) & ((b[:, 20] & 0x1f) == 0) & (b[:, 21] == 0)
+    puerto_origen = b[:, 0x22].astype(np.uint16) << 8 | b[:, 0x23]
+    puerto_destino = b[:, 0x24].astype(np.uint16) << 8 | b[:, 0x25]
+    valida &= (puerto_origen == puerto) | (puerto_destino == puerto)
+    
+    bcch = b[:, 0x36] == 0x01
+    identidad = valida & ~bcch & (b[:, 0x3c] == 0x21)
+    reasignacion = valida & ~bcch & (b[:, 0x3c] == 0x22)
+    imsi_solicitado = (b[:, 0x3e] == 0x08) & ((b[:, 0x3f] & 0x1) == 0x1)
+    segundo_imsi = (b[:, 0x3a] == 0x59) & (b[:, 0x48] == 0x08) & ((b[:, 0x49] & 0x1) == 0x1)
+    imsi_con_tmsi = (b[:, 0x45] == 0x08) & ((b[:, 0x46] & 0x1) == 0x1)
+    tmsi1 = (b[:, 0x3e] == 0x05) & ((b[:, 0x3f] & 0x07) == 4)
+    tmsi2 = (b[:, 0x45] == 0x05) & ((b[:, 0x46] & 0x07) == 4)
+    
+    # np.select se queda con la primera condición cierta, igual que la cascada de analizar_gsmtap
+    # (IDENTIDAD_IMSI_TMSI repite la condición de IDENTIDAD_IMSI_IMSI y nunca se alcanza, tampoco allí)
+    return np.select(
+        [valida & bcch & (b[:, 0x3c] == 0x1b),
+         identidad & imsi_solicitado & segundo_imsi,
+         identidad & imsi_solicitado,
+         identidad & imsi_con_tmsi,
+         identidad & tmsi1 & tmsi2,
+         identidad & tmsi1,
+         reasignacion & (b[:, 0x47] == 0x08) & ((b[:, 0x48] & 0x1) == 0x1)],
+        [INFO_SISTEMA_3, IDENTIDAD_IMSI_IMSI, IDENTIDAD_IMSI, IDENTIDAD_TMSI_IMSI,
+         IDENTIDAD_TMSI_TMSI, IDENTIDAD_TMSI, REASIGNACION_TMSI],
+        SIN_COINCIDENCIA)
+
+def leer_pcap(ruta, puerto, contexto):
+    """
+    Análisis offline de una captura pcap (Ethernet): las tramas se clasifican todas a la vez
+    con numpy y solo las reconocidas pasan por los manejadores, en el orden de la captura
+    """
+    # numpy es opcional para la captura en vivo, no para este modo
+    if np is None:
+        raise ImportError("el análisis de archivos pcap (-r/--pcap) necesita numpy")
+    
+    with open(ruta, 'rb') as archivo:
+        contenido = archivo.read()
+    
+    if len(contenido) < 24:
+        raise ValueError(f"{ruta}: archivo pcap truncado, falta la cabecera global")
+    magic, = struct.unpack_from('<I', contenido, 0)
+    if magic not in ORDEN_PCAP:
+        raise ValueError(f"{ruta}: no es un archivo pcap (¿pcapng?)")
+    orden = ORDEN_PCAP[magic]
+    tipo_enlace, = struct.unpack_from(orden + 'I', contenido, 20)
+    if tipo_enlace != LINKTYPE_ETHERNET:
+        raise ValueError(f"{ruta}: tipo de enlace {tipo_enlace} no soportado, solo Ethernet")
+    
+    # Los registros tienen longitud variable: se recorren las cabeceras para situar cada trama
+    cabecera_registro = struct.Struct(orden + '8xI4x')
+    inicios = []
+    longitudes = []
+    posicion = 24
+    while posicion + 16 <= len(contenido):
+        longitud, = cabecera_registro.unpack_from(contenido, posicion)
+        posicion += 16
+        inicios.append(posicion)
+        longitudes.append(min(longitud, len(contenido) - posicion))
+        posicion += longitud
+    if not inicios:
+        return
+    
+    # Tabla de tramas rellena con ceros hasta COLUMNAS_PCAP, construida con un único índice
+    datos = np.frombuffer(contenido, dtype=np.uint8)
+    inicios = np.array(inicios, dtype=np.int64)
+    longitudes = np.array(longitudes, dtype=np.int64)
+    columnas = np.arange(COLUMNAS_PCAP)
+    indices = np.minimum(inicios[:, None] + columnas, len(datos) - 1)
+    tabla = np.where(columnas < longitudes[:, None], datos[indices], 0).astype(np.uint8)
+    
+    tipos = clasificar_tabla(tabla, longitudes, puerto)
+    vista = memoryview(contenido)
+    for i in np.flatnonzero(tipos):
+        DESPACHO[tipos[i]](contexto, vista[inicios[i]:inicios[i] + longitudes[i]])
 
 def main():
     """Función principal"""
-    global mostrar_todos_tmsi, imsi_a_seguir, longitud_imsi_seguir
-    
     parser = OptionParser(usage="%prog: [opciones]")
     parser.add_option("-a", "--todos-tmsi", action="store_true", dest="mostrar_todos_tmsi", 
                      help="Mostrar TMSI que no tienen IMSI asociado (por defecto: false)")
@@ -246,20 +649,20 @@ def main():
                      help='IMSI a rastrear (por defecto: ninguno, Ejemplo: 123456789101112 o "123 45 6789101112")')
     parser.add_option("-p", "--puerto", dest="puerto", default="4729", type="int",
                      help="Puerto (por defecto: 4729)")
+    parser.add_option("-r", "--pcap", dest="pcap", default="", type="string",
+                     help="Analizar una captura pcap en lugar de la interfaz (por defecto: ninguna)")
     
     (opciones, args) = parser.parse_args()
     
-    mostrar_todos_tmsi = opciones.mostrar_todos_tmsi
-    
     # Procesar IMSI a rastrear
+    imsi_a_seguir = b""
     if opciones.imsi:
         imsi = "9" + opciones.imsi.replace(" ", "")
         longitud_imsi = len(imsi)
         
-        if longitud_imsi % 2 == 0 and 0 < longitud_imsi < 17:
-            for i in range(0, longitud_imsi - 1, 2):
-                imsi_a_seguir += chr(int(imsi[i + 1]) * 16 + int(imsi[i]))
-            longitud_imsi_seguir = len(imsi_a_seguir)
+        if longitud_imsi % 2 == 0 and 0 < longitud_imsi < 17 and imsi.isdigit():
+            # Misma codificación que en el paquete: dígitos BCD con los nibbles intercambiados
+            imsi_a_seguir = bytes.fromhex("".join(imsi[i + 1] + imsi[i] for i in range(0, longitud_imsi - 1, 2)))
         else:
             print("¡Tamaño incorrecto para el IMSI a rastrear!")
             print("Tamaños válidos:")
@@ -267,12 +670,19 @@ def main():
                 print(f"- {longitud} dígitos")
             sys.exit(1)
     
+    # Salida por lotes: se vuelca cada 200 ms, al pasar de LIMITE_SALIDA y al salir, no tras cada línea
+    atexit.register(volcar_salida)
+    threading.Thread(target=vaciar_salida_periodicamente, daemon=True).start()
+    
     # Encabezado de la tabla de resultados
-    print(f"{'Nº IMSI':7s} ; {'T-IMSI1':10s} ; {'T-IMSI2':10s} ; {'IMSI':17s} ; {'País':12s} ; {'Marca':10s} ; {'Operador':21s} ; {'MCC':5s} ; {'MNC':4s} ; {'LAC':5s} ; {'Celda':6s}")
+    escribir_linea(f"{'Nº IMSI':7s} ; {'T-IMSI1':10s} ; {'T-IMSI2':10s} ; {'IMSI':17s} ; {'País':12s} ; {'Marca':10s} ; {'Operador':21s} ; {'MCC':5s} ; {'MNC':4s} ; {'LAC':5s} ; {'Celda':6s}")
     
     # Iniciar captura de paquetes
-    filtro = f"port {opciones.puerto} and not icmp and udp"
-    sniff(iface=opciones.interfaz, filter=filtro, prn=buscar_imsi, store=0)
+    contexto = Contexto(imsi_a_seguir, opciones.mostrar_todos_tmsi)
+    if opciones.pcap:
+        leer_pcap(opciones.pcap, opciones.puerto, contexto)
+    else:
+        leer_paquetes(abrir_captura(opciones.interfaz, opciones.puerto), contexto)
 
 if __name__ == '__main__':
     main()